@@ -0,0 +1,60 @@
+import os as os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+cache_dir = "./data/cache"
+
+def cache_key(files, fields, stat_files=()):
+    """Hashes the contents of files together with the repr of fields
+
+    stat_files are only keyed on their path, size and modification time, for files too large
+    to read on every startup."""
+    h = hashlib.sha1()
+    for fname in files:
+        h.update("%d\0" % os.path.getsize(fname))
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    for fname in stat_files:
+        st = os.stat(fname)
+        h.update("%s\0%d\0%r\0" % (os.path.abspath(fname), st.st_size, st.st_mtime))
+    h.update(repr(fields))
+    return h.hexdigest()
+
+def load_arrays(key):
+    """Returns the dict saved under key with arrays memory-mapped read-only, or None"""
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+
+    with open(os.path.join(path, "meta.json")) as f:
+        data = dict((str(k), v) for k, v in json.load(f).iteritems())
+    for fname in os.listdir(path):
+        if fname.endswith(".npy"):
+            data[fname[:-len(".npy")]] = np.load(os.path.join(path, fname), mmap_mode='r')
+    return data
+
+def save_arrays(key, data):
+    """Saves a dict of numpy arrays and json-serializable values under key"""
+    path = os.path.join(cache_dir, key)
+    # write to a private directory first so readers never see a partial entry
+    tmp_path = "%s.tmp%d" % (path, os.getpid())
+    os.makedirs(tmp_path)
+
+    meta = {}
+    for name, value in data.iteritems():
+        if isinstance(value, np.ndarray):
+            np.save(os.path.join(tmp_path, name + ".npy"), value)
+        else:
+            meta[name] = value
+    with open(os.path.join(tmp_path, "meta.json"), 'w') as f:
+        json.dump(meta, f)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process cached the same key first
+        shutil.rmtree(tmp_path)
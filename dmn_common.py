@@ -0,0 +1,57 @@
+import os as os
+
+import numpy as np
+
+import vocab_store
+
+# weights file of each task
+task_weights = {"squad": "weights/SQUAD.weights", "toefl": "weights/TOEFL.weights"}
+
+# questions processed at a time
+window = 1000
+
+def add_task_arguments(parser):
+    parser.add_argument("-t", "--task", default="squad", help="specify the model, squad or toefl (default=squad)")
+    parser.add_argument("-w", "--weights", help="specify the weights file (default=weights/SQUAD.weights or weights/TOEFL.weights)")
+
+def load_task(args):
+    """Input module and weights file of the task and weights given on the command line
+
+    Checkpoints trained before the vocab was saved with them get it rebuilt first."""
+    if args.task not in task_weights:
+        raise NotImplementedError(args.task + ' is not a supported task')
+    input_module = __import__(args.task + "_input")
+    weights = args.weights if args.weights is not None else task_weights[args.task]
+
+    if not os.path.exists(vocab_store.vocab_path(weights)):
+        vocab_store.migrate_vocab(weights, input_module, __import__(args.task + "_plus").Config())
+    return input_module, weights
+
+def get_test_data(input_module, items, vocab, ivocab, max_sen_len, config):
+    """Test data tuple of question items in the data file format, using a saved vocab"""
+    tasks = list(input_module.iter_tasks(items))
+    return input_module.process_test_tasks(tasks, vocab, ivocab, max_sen_len, config, split_sentences=True)
+
+def strip_answers(items):
+    """Question items without their answers, which would make the input module drop candidates"""
+    return [dict((k, v) for k, v in item.iteritems() if k != "answer") for item in items]
+
+def split_questions(preds, context_ids):
+    """Splits the scores of the tasks of test data into the scores of the answer candidates of each question"""
+    # tasks of a question are consecutive and share a context id
+    return np.split(preds, np.flatnonzero(np.diff(context_ids)) + 1)
+
+def best_answers(scores):
+    """Index of the highest scoring answer candidate of each question"""
+    return [np.argmax(s) for s in scores]
+
+def write_answers(model, input_module, fname):
+    """Writes the answers of a data file to answer.txt, reading it window questions at a time
+
+    model is a NumpyDMN or FrozenDMN."""
+    print '==> running DMN'
+    with open("answer.txt", "w") as answer_file:
+        for tasks in input_module.iter_windows(input_module.iter_babi(fname), window):
+            data = input_module.process_test_tasks(tasks, model.vocab, model.ivocab, model.max_sen_len, model.config, split_sentences=True)
+            for answer in model.predict_answers(data):
+                answer_file.write(str(answer) + "\n")
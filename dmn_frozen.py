@@ -0,0 +1,120 @@
+import os as os
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+import vocab_store
+import slim_store
+import dmn_common
+
+# placeholders the prediction is fed through, in get_batch_arrays order, None for the ones it does not read
+feed_names = ["questions", "inputs", "question_lens", "input_lens", "contexts", None, None,
+              "question_suffixes", "question_suffix_lens"]
+
+def frozen_path(weights_file):
+    """Frozen graph saved next to a weights file, e.g. weights/SQUAD.weights -> weights/SQUAD.frozen.pb"""
+    return os.path.splitext(weights_file)[0] + ".frozen.pb"
+
+def _bypass_dropout(graph_def, keep_prob):
+    """Rewires the consumers of each dropout to its input, dropout keeps everything at test time"""
+    nodes = dict((node.name, node) for node in graph_def.node)
+    bypass = {}
+    # tf.nn.dropout returns (x / keep_prob) * floor(keep_prob + random)
+    for node in graph_def.node:
+        div = nodes.get(node.input[0]) if node.op == "Mul" and node.input else None
+        if div is not None and div.op == "Div" and div.input[1] == keep_prob:
+            bypass[node.name] = div.input[0]
+    for node in graph_def.node:
+        node.input[:] = [bypass.get(name, name) for name in node.input]
+
+def export_frozen(dmn, weights_file, scope="DMN"):
+    """Writes the graph computing pred from a checkpoint, with the variables folded into constants
+
+    The placeholders fed from the prefetch queue become plain placeholders and dropout is removed,
+    so the graph holds no queue, loss, gradient, optimizer or summary nodes."""
+    config = dmn.Config()
+    config.train_mode = False
+    config.test_file = None
+    config.vocab_file = vocab_store.vocab_path(weights_file)
+
+    with tf.Graph().as_default(), tf.Session() as session:
+        with tf.variable_scope(scope):
+            model = dmn.DMN_PLUS(config)
+        # slim weights leave the embedding to its initializer
+        session.run(tf.initialize_all_variables())
+        slim_store.restore_weights(session, weights_file)
+        graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph_def, [model.pred.op.name])
+
+    for node in graph_def.node:
+        if node.op == "PlaceholderWithDefault":
+            node.op = "Placeholder"
+            del node.input[:]
+    _bypass_dropout(graph_def, model.dropout_placeholder.op.name)
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, [model.pred.op.name])
+
+    with open(frozen_path(weights_file), "wb") as f:
+        f.write(graph_def.SerializeToString())
+    print "==> wrote %d node frozen graph to %s" % (len(graph_def.node), frozen_path(weights_file))
+
+class FrozenDMN(object):
+    """Scores test data with the frozen graph written by export_frozen
+
+    Takes the same test data tuples as DMN_PLUS and returns the same scores."""
+
+    def __init__(self, weights_file, dmn, input_module, config=None, scope="DMN"):
+        self.dmn = dmn
+        self.input_module = input_module
+        self.config = config if config is not None else dmn.Config()
+        self.vocab, self.ivocab, _, self.max_sen_len = vocab_store.load_vocab(vocab_store.vocab_path(weights_file))
+
+        graph_def = tf.GraphDef()
+        with open(frozen_path(weights_file), "rb") as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=self.graph)
+
+        self.placeholders = [self.graph.get_tensor_by_name(scope + "/" + name + ":0") if name else None for name in feed_names]
+        self.pred = self.graph.get_tensor_by_name(scope + "/pred:0")
+
+    def get_test_data(self, items):
+        return dmn_common.get_test_data(self.input_module, items, self.vocab, self.ivocab, self.max_sen_len, self.config)
+
+    def predict_scores(self, data):
+        """Returns the scores of the answer candidates of each question"""
+        preds = []
+        for start in range(0, len(data[0]), self.config.test_batch_size):
+            index = range(start, min(start + self.config.test_batch_size, len(data[0])))
+            arrays = self.dmn.get_batch_arrays(data, index)
+            feed = dict((p, array) for p, array in zip(self.placeholders, arrays) if p is not None)
+            preds.append(np.reshape(self.session.run(self.pred, feed_dict=feed), (-1,)))
+        return dmn_common.split_questions(np.concatenate(preds), data[7])
+
+    def predict_answers(self, data):
+        return dmn_common.best_answers(self.predict_scores(data))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    dmn_common.add_task_arguments(parser)
+    parser.add_argument("-i", "--input_data", default="data/test.json", help="specify the input data (default=data/test.json)")
+    parser.add_argument("-e", "--export", action="store_true", help="export the frozen graph of the checkpoint and exit")
+    parser.add_argument("-s", "--test_batch_size", type=int, help="specify the number of tasks scored per step")
+    args = parser.parse_args()
+
+    dmn_input, weights = dmn_common.load_task(args)
+    dmn = __import__(args.task + "_plus")
+
+    if args.export or not os.path.exists(frozen_path(weights)):
+        export_frozen(dmn, weights)
+        if args.export:
+            exit()
+
+    config = dmn.Config()
+    if args.test_batch_size is not None:
+        config.test_batch_size = args.test_batch_size
+
+    model = FrozenDMN(weights, dmn, dmn_input, config)
+    dmn_common.write_answers(model, dmn_input, args.input_data)
@@ -0,0 +1,279 @@
+import os as os
+import argparse
+
+import numpy as np
+
+import vocab_store
+import dmn_common
+
+# bump when the layout of the exported arrays changes
+EXPORT_VERSION = 1
+
+class Config(object):
+    """Test settings of dmn_plus.Config the engine needs, kept here so it never imports tensorflow"""
+
+    floatX = np.float32
+    embed_size = 100
+    max_allowed_inputs = 100
+    test_batch_size = 64
+
+def numpy_path(weights_file, quantized=False):
+    """Exported weights saved next to a weights file, e.g. weights/SQUAD.weights -> weights/SQUAD.numpy.npz
+    or weights/SQUAD.int8.npz when quantized"""
+    return os.path.splitext(weights_file)[0] + (".int8.npz" if quantized else ".numpy.npz")
+
+def quantize(matrix, axis):
+    """Symmetric int8 quantization with a float32 scale per row (axis=1) or per column (axis=0)
+
+    Returns the values and the scales, matrix is about values * scales."""
+    scales = np.max(np.abs(matrix), axis=axis, keepdims=True) / 127.
+    scales[scales == 0] = 1
+    values = np.round(matrix / scales).astype(np.int8)
+    return values, scales.astype(np.float32)
+
+def export_weights(weights_file, scope="DMN", quantized=False):
+    """Copies the model variables of a checkpoint into an npz file, leaving out the optimizer slots
+
+    When quantized, the embedding is stored as int8 with a scale per word and the weight
+    matrices with a scale per output unit, under name and name + "/scale"."""
+    # only exporting needs tensorflow
+    import tensorflow as tf
+
+    reader = tf.train.NewCheckpointReader(weights_file)
+    arrays = {}
+    for name in reader.get_variable_to_shape_map():
+        if "Adam" in name or name.endswith("_power"):
+            continue
+        array = reader.get_tensor(name)
+        name = name[len(scope)+1:]
+        if quantized and array.ndim == 2 and "bias" not in name.lower():
+            arrays[name], arrays[name + "/scale"] = quantize(array, 1 if name == "Embedding" else 0)
+        else:
+            arrays[name] = array
+    np.savez(numpy_path(weights_file, quantized), version=EXPORT_VERSION, **arrays)
+    print "==> exported %d variables to %s" % (len([name for name in arrays if not name.endswith("/scale")]), numpy_path(weights_file, quantized))
+
+def _position_encoding(sentence_size, embedding_size):
+    """Same encoding as dmn_plus._position_encoding, without the loops"""
+    encoding = np.outer(np.arange(1, embedding_size+1) - embedding_size/2, np.arange(1, sentence_size+1) - sentence_size/2).astype(np.float32)
+    encoding = 1 + 4 * encoding / embedding_size / sentence_size
+    return np.transpose(encoding)
+
+def _sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+def _matmul(x, w):
+    """x.dot(w) over the last axis of x, as a single 2d matmul numpy runs with blas"""
+    return x.reshape(-1, x.shape[-1]).dot(w).reshape(x.shape[:-1] + (w.shape[1],))
+
+def _reverse(x, lens):
+    """Reverses the first lens[i] steps of each row like tf.reverse_sequence"""
+    steps = np.arange(x.shape[1])
+    index = np.where(steps < lens[:, None], lens[:, None] - 1 - steps, steps)
+    return x[np.arange(len(x))[:, None], index]
+
+def _gru(cell, inputs, lens, state=None):
+    """Runs a tensorflow GRUCell over inputs (batch, time, dim) up to the len of each row
+
+    Like dynamic_rnn, the outputs past a row's len are zeros and its state is carried through.
+    Returns the outputs and the final states."""
+    gates_w, gates_b, candidate_w, candidate_b = cell
+    n, steps, dim = inputs.shape
+    h = len(candidate_b)
+    if state is None:
+        state = np.zeros((n, h), dtype=np.float32)
+
+    # input projections of every step at once, only the recurrent matmuls run in the loop
+    gates_in = _matmul(inputs, gates_w[:dim]) + gates_b
+    candidate_in = _matmul(inputs, candidate_w[:dim]) + candidate_b
+
+    outputs = np.zeros((n, steps, h), dtype=np.float32)
+    for t in range(steps):
+        gates = _sigmoid(gates_in[:, t] + state.dot(gates_w[dim:]))
+        r, u = gates[:, :h], gates[:, h:]
+        candidate = np.tanh(candidate_in[:, t] + (r * state).dot(candidate_w[dim:]))
+        live = (t < lens)[:, None]
+        state = np.where(live, u * state + (1 - u) * candidate, state)
+        outputs[:, t] = np.where(live, state, 0)
+    return outputs, state
+
+class _QuantizedEmbedding(object):
+    """Int8 embedding with a scale per word, the rows are dequantized when looked up"""
+
+    def __init__(self, values, scales):
+        self.values, self.scales = values, scales
+        self.shape = values.shape
+        self.nbytes = values.nbytes + scales.nbytes
+
+    def __getitem__(self, ids):
+        return self.values[ids] * self.scales[ids]
+
+class NumpyDMN(object):
+    """Forward pass of a DMN_PLUS model in NumPy, from the weights written by export_weights
+
+    Takes the same test data tuples as DMN_PLUS and returns the same scores up to float rounding.
+    With quantized weights the embedding stays int8 in memory and the other matrices are
+    dequantized once when loading."""
+
+    def __init__(self, weights_file, input_module, config=None, quantized=False):
+        self.config = config if config is not None else Config()
+        self.input_module = input_module
+
+        fname = numpy_path(weights_file, quantized)
+        saved = np.load(fname)
+        if int(saved["version"]) != EXPORT_VERSION:
+            raise Exception("%s has export version %d, expected %d" % (fname, saved["version"], EXPORT_VERSION))
+        w = {}
+        for name in saved.files:
+            if name == "version" or name.endswith("/scale"):
+                continue
+            if name + "/scale" not in saved.files:
+                w[name] = saved[name]
+            elif name == "Embedding":
+                w[name] = _QuantizedEmbedding(saved[name], saved[name + "/scale"])
+            else:
+                w[name] = saved[name] * saved[name + "/scale"]
+        self.memory_bytes = dict((name, array.nbytes) for name, array in w.iteritems())
+
+        self.vocab, self.ivocab, _, self.max_sen_len = vocab_store.load_vocab(vocab_store.vocab_path(weights_file))
+        self.embeddings = w["Embedding"]
+        self.encoding = _position_encoding(self.max_sen_len, self.embeddings.shape[1])
+
+        def cell(scope):
+            return [w[scope + "/GRUCell/" + name] for name in ("Gates/Linear/Matrix", "Gates/Linear/Bias", "Candidate/Linear/Matrix", "Candidate/Linear/Bias")]
+        self.question_cell = cell("question/RNN")
+        self.fw_cell = cell("input/BiRNN/FW")
+        self.bw_cell = cell("input/BiRNN/BW")
+
+        # rows of W_1 follow the features [f*q, f*m, |f-q|, |f-m|]
+        W_fq, W_fm, W_dq, W_dm = np.split(w["memory/attention/W_1"], 4)
+        self.W_q, self.W_m = np.concatenate([W_fq, W_dq]), np.concatenate([W_fm, W_dm])
+        self.b_1, self.W_2, self.b_2 = w["memory/attention/bias_1"], w["memory/attention/W_2"], w["memory/attention/bias_2"]
+
+        self.attention_gru = [w["memory/attention_gru/" + name] for name in ("Wr", "Ur", "bias_r", "W", "U", "bias_h")]
+        self.num_hops = sum(1 for name in w if name.startswith("memory/W_t"))
+        self.memory = [(w["memory/W_t" + str(i)], w["memory/bias_t" + str(i)]) for i in range(self.num_hops)]
+        self.U, self.b_p = w["answer/U"], w["answer/bias_p"]
+
+    def get_test_data(self, items):
+        return dmn_common.get_test_data(self.input_module, items, self.vocab, self.ivocab, self.max_sen_len, self.config)
+
+    def get_input_representation(self, inputs, input_lens):
+        """Fact vectors of the contexts, inputs are cut to the longest sentence like in DMN_PLUS"""
+        sen_len = inputs.shape[2]
+        sentences = np.sum(self.embeddings[inputs] * self.encoding[:sen_len], 2)
+        sentences += self.embeddings[0] * np.sum(self.encoding[sen_len:], 0)
+
+        fw, _ = _gru(self.fw_cell, sentences, input_lens)
+        bw, _ = _gru(self.bw_cell, _reverse(sentences, input_lens), input_lens)
+        return fw + _reverse(bw, input_lens)
+
+    def generate_episode(self, memory, question_attention, fact_vecs, fact_inputs, mask):
+        """Attention over the facts followed by the attention GRU"""
+        m = memory[:, None]
+        features = np.concatenate([fact_vecs * m, np.abs(fact_vecs - m)], 2)
+        hidden = np.tanh(question_attention + _matmul(features, self.W_m))
+        attentions = np.where(mask, _matmul(hidden, self.W_2)[:, :, 0] + self.b_2, -1e30)
+
+        attentions = np.exp(attentions - np.max(attentions, 1, keepdims=True))
+        g = (attentions / np.sum(attentions, 1, keepdims=True))[:, :, None]
+
+        _, Ur, br, _, U, bh = self.attention_gru
+        input_r, input_h = fact_inputs
+        episode = np.zeros_like(memory)
+        for t in range(fact_vecs.shape[1]):
+            r = _sigmoid(input_r[:, t] + episode.dot(Ur) + br)
+            h_hat = np.tanh(input_h[:, t] + r * episode.dot(U) + bh)
+            episode = np.where(mask[:, t:t+1], g[:, t] * h_hat + (1 - g[:, t]) * episode, episode)
+        return episode
+
+    def forward(self, questions, q_lens, inputs, input_lens, context_index):
+        """Scores of the tasks of a batch, each task reads the facts of its row in inputs"""
+        _, q_vec = _gru(self.question_cell, self.embeddings[questions], q_lens)
+
+        fact_vecs = self.get_input_representation(inputs, input_lens)[context_index]
+        fact_lens = input_lens[context_index]
+        mask = np.arange(fact_vecs.shape[1]) < fact_lens[:, None]
+
+        q = q_vec[:, None]
+        question_attention = _matmul(np.concatenate([fact_vecs * q, np.abs(fact_vecs - q)], 2), self.W_q) + self.b_1
+        # the attention GRU input projections are the same for every hop
+        Wr, _, _, W, _, _ = self.attention_gru
+        fact_inputs = _matmul(fact_vecs, Wr), _matmul(fact_vecs, W)
+
+        memory = q_vec
+        for Wt, bt in self.memory:
+            episode = self.generate_episode(memory, question_attention, fact_vecs, fact_inputs, mask)
+            memory = np.maximum(np.concatenate([memory, episode, q_vec], 1).dot(Wt) + bt, 0)
+
+        return _sigmoid(np.concatenate([memory, q_vec], 1).dot(self.U) + self.b_p)[:, 0]
+
+    def predict_scores(self, data):
+        """Returns the scores of the answer candidates of each question"""
+        qp, ip, ql, il, im, a, r, c, sl, nw = data
+        preds = []
+        for start in range(0, len(qp), self.config.test_batch_size):
+            index = np.arange(start, min(start + self.config.test_batch_size, len(qp)))
+            contexts, context_index = np.unique(c[index], return_inverse=True)
+            # cut to the longest question, context and sentence of the batch
+            inputs = ip[contexts, :max(np.max(il[contexts]), 1), :max(np.max(sl[contexts]), 1)].astype(np.int32)
+            questions = qp[index, :max(np.max(ql[index]), 1)].astype(np.int32)
+            preds.append(self.forward(questions, ql[index], inputs, il[contexts], context_index))
+        return dmn_common.split_questions(np.concatenate(preds), c)
+
+    def predict_answers(self, data):
+        return dmn_common.best_answers(self.predict_scores(data))
+
+def compare_quantized(weights_file, input_module, config, fname, window=dmn_common.window):
+    """Prints the accuracy and memory of the float32 and int8 engines on a data file, and how often they agree"""
+    items = list(input_module.iter_json_items(fname))
+    models = [NumpyDMN(weights_file, input_module, config, quantized) for quantized in (False, True)]
+
+    scores = [[], []]
+    for start in range(0, len(items), window):
+        # both engines read the same vocab, so the data is processed once
+        data = models[0].get_test_data(dmn_common.strip_answers(items[start:start+window]))
+        for model, model_scores in zip(models, scores):
+            model_scores += model.predict_scores(data)
+
+    answers = [np.array(dmn_common.best_answers(model_scores)) for model_scores in scores]
+    labels = [item["answer"] if isinstance(item["answer"], list) else [item["answer"]] for item in items if "answer" in item]
+    for model, quantized, model_answers in zip(models, (False, True), answers):
+        report = "==> %s: " % ("int8" if quantized else "float32")
+        if len(labels) == len(items):
+            report += "accuracy %.1f%%, " % (100. * np.mean([a in label for a, label in zip(model_answers, labels)]))
+        embedding = model.memory_bytes["Embedding"]
+        report += "embedding %.2fMB, other weights %.2fMB in memory, %.2fMB file" % (
+            embedding / 1e6, (sum(model.memory_bytes.values()) - embedding) / 1e6, os.path.getsize(numpy_path(weights_file, quantized)) / 1e6)
+        print report
+    print "==> answers agree on %.1f%% of %d questions, max score difference %.1e" % (
+        100. * np.mean(answers[0] == answers[1]), len(items), max(np.max(np.abs(a - b)) for a, b in zip(*scores)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    dmn_common.add_task_arguments(parser)
+    parser.add_argument("-i", "--input_data", default="data/test.json", help="specify the input data (default=data/test.json)")
+    parser.add_argument("-e", "--export", action="store_true", help="export the weights of the checkpoint and exit")
+    parser.add_argument("-q", "--int8", action="store_true", help="use the int8 quantized weights")
+    parser.add_argument("-c", "--compare", action="store_true", help="compare the accuracy and memory of the float32 and int8 weights on the input data")
+    parser.add_argument("-s", "--test_batch_size", type=int, help="specify the number of tasks scored at a time")
+    args = parser.parse_args()
+
+    dmn_input, weights = dmn_common.load_task(args)
+
+    for quantized in ([False, True] if args.compare else [args.int8]):
+        if args.export or not os.path.exists(numpy_path(weights, quantized)):
+            export_weights(weights, quantized=quantized)
+    if args.export:
+        exit()
+
+    config = Config()
+    if args.test_batch_size is not None:
+        config.test_batch_size = args.test_batch_size
+
+    if args.compare:
+        compare_quantized(weights, dmn_input, config, args.input_data)
+        exit()
+
+    model = NumpyDMN(weights, dmn_input, config, args.int8)
+    dmn_common.write_answers(model, dmn_input, args.input_data)
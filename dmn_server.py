@@ -0,0 +1,176 @@
+import os as os
+import json
+import argparse
+import traceback
+import BaseHTTPServer
+import SocketServer
+
+import numpy as np
+
+import vocab_store
+import dmn_common
+from micro_batcher import MicroBatcher
+
+parser = argparse.ArgumentParser()
+dmn_common.add_task_arguments(parser)
+parser.add_argument("-p", "--port", type=int, default=8000, help="specify the port to listen on (default=8000)")
+parser.add_argument("--host", default="127.0.0.1", help="specify the address to listen on (default=127.0.0.1)")
+parser.add_argument("-s", "--test_batch_size", type=int, help="specify the number of tasks scored per step")
+parser.add_argument("-b", "--max_batch_size", type=int, default=16, help="specify the number of questions /score requests are batched up to (default=16)")
+parser.add_argument("-m", "--max_wait", type=float, default=5, help="specify how long in ms a /score request waits for others to batch with (default=5)")
+parser.add_argument("-n", "--numpy", action="store_true", help="serve with the NumPy engine instead of tensorflow, exporting the weights on first use")
+parser.add_argument("-q", "--int8", action="store_true", help="with --numpy, serve the int8 quantized weights")
+parser.add_argument("-f", "--frozen", action="store_true", help="serve from the frozen inference graph, exporting it on first use")
+args = parser.parse_args()
+
+dmn_input, weights = dmn_common.load_task(args)
+
+def load_numpy_model():
+    """NumPy engine and its scoring function, tensorflow is only imported to export the weights once"""
+    import dmn_numpy
+    if not os.path.exists(dmn_numpy.numpy_path(weights, args.int8)):
+        dmn_numpy.export_weights(weights, quantized=args.int8)
+
+    config = dmn_numpy.Config()
+    if args.test_batch_size is not None:
+        config.test_batch_size = args.test_batch_size
+
+    print '==> loading weights'
+    model = dmn_numpy.NumpyDMN(weights, dmn_input, config, args.int8)
+    return model, model.predict_scores
+
+def load_frozen_model():
+    """Frozen graph and its scoring function, the training graph is only built to export it once"""
+    import dmn_frozen
+    dmn = __import__(args.task + "_plus")
+    if not os.path.exists(dmn_frozen.frozen_path(weights)):
+        dmn_frozen.export_frozen(dmn, weights)
+
+    config = dmn.Config()
+    if args.test_batch_size is not None:
+        config.test_batch_size = args.test_batch_size
+
+    print '==> loading frozen graph'
+    model = dmn_frozen.FrozenDMN(weights, dmn, dmn_input, config)
+    return model, model.predict_scores
+
+def load_tf_model():
+    """Tensorflow model and its scoring function"""
+    import tensorflow as tf
+    import slim_store
+    # e.g. squad_plus for squad_input
+    dmn = __import__(args.task + "_plus")
+
+    config = dmn.Config()
+
+    if args.test_batch_size is not None:
+        config.test_batch_size = args.test_batch_size
+
+    config.strong_supervision = False
+    # requests are scored from several threads, they must not share the prefetch queue
+    config.prefetch_batches = 0
+
+    config.train_mode = False
+    # questions arrive with the requests, the model only loads the vocab saved with the weights
+    config.test_file = None
+    config.vocab_file = vocab_store.vocab_path(weights)
+
+    with tf.variable_scope('DMN'):
+        model = dmn.DMN_PLUS(config)
+
+    print '==> initializing variables'
+    session = tf.Session()
+    session.run(tf.initialize_all_variables())
+
+    slim_store.restore_weights(session, weights)
+    return model, lambda data: model.predict_scores(session, data)
+
+print 'Serving DMN ' + args.task
+
+if args.numpy:
+    model, predict_scores = load_numpy_model()
+elif args.frozen:
+    model, predict_scores = load_frozen_model()
+else:
+    model, predict_scores = load_tf_model()
+
+def check_item(item):
+    """Whether item is a question object the input module can read, with at least one sentence in its context"""
+    return (isinstance(item, dict) and isinstance(item.get("context"), basestring) and isinstance(item.get("question"), basestring)
+            and isinstance(item.get("answer_list"), list) and len(item["answer_list"]) > 0
+            and all(isinstance(answer, basestring) for answer in item["answer_list"])
+            and len(dmn_input.tokenize_context(item["context"].encode('utf-8'), split_sentences=True)) > 0)
+
+def check_items(items):
+    """Question items in the data file format, without the answers that would make the input module drop candidates"""
+    if not isinstance(items, list) or not all(check_item(item) for item in items):
+        raise ValueError("expected question objects with a context of at least one sentence, a question and a non-empty answer_list of strings")
+    return dmn_common.strip_answers(items)
+
+def score_items(items):
+    """Scores every answer candidate of the items"""
+    scores = []
+    for start in range(0, len(items), dmn_common.window):
+        scores += predict_scores(model.get_test_data(items[start:start+dmn_common.window]))
+    return scores
+
+# /score requests of concurrent clients share batches, whole files sent to /answers are scored on their own
+batcher = MicroBatcher(score_items, args.max_batch_size, args.max_wait / 1000.)
+
+class DMNHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """POST /score takes a question object (or a list of them) and returns the candidate scores and answer,
+    POST /answers takes a whole data file and returns answer.txt, GET /ping checks the server is up
+    and GET /stats returns the latency and batch size statistics of /score and the fact cache hit rate"""
+
+    def send(self, code, body, content_type="text/plain"):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/ping":
+            self.send(200, "ok\n")
+        elif self.path == "/stats":
+            stats = batcher.stats()
+            if not (args.numpy or args.frozen) and model.fact_cache is not None:
+                stats["fact_cache"] = model.fact_cache.stats()
+            self.send(200, json.dumps(stats), "application/json")
+        else:
+            self.send(404, "not found\n")
+
+    def do_POST(self):
+        if self.path not in ("/score", "/answers"):
+            self.send(404, "not found\n")
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))))
+            items = check_items([body] if self.path == "/score" and not isinstance(body, list) else body)
+        except Exception as e:
+            self.send(400, "bad request: %s\n" % e)
+            return
+
+        try:
+            if self.path == "/score":
+                scores = batcher.submit(items)
+            else:
+                scores = score_items(items)
+        except Exception as e:
+            # the request was valid, keep serving the others
+            traceback.print_exc()
+            self.send(500, "scoring failed: %s\n" % e)
+            return
+
+        if self.path == "/score":
+            results = [{"scores": s.tolist(), "answer": int(np.argmax(s))} for s in scores]
+            self.send(200, json.dumps(results if isinstance(body, list) else results[0]), "application/json")
+        else:
+            self.send(200, "".join(str(answer) + "\n" for answer in dmn_common.best_answers(scores)))
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+server = ThreadingHTTPServer((args.host, args.port), DMNHandler)
+print '==> listening on %s:%d' % (args.host, args.port)
+server.serve_forever()
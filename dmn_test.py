@@ -1,13 +1,17 @@
 import tensorflow as tf
-import numpy as np
 
 import time
 import argparse
 
+import vocab_store
+import slim_store
+
 parser = argparse.ArgumentParser()
 parser.add_argument("-b", "--babi_task_id", help="specify babi task 1-20 (default=1)")
 parser.add_argument("-t", "--dmn_type", help="specify type of dmn (default=original)")
 parser.add_argument("-i", "--input_data", help="specify the input data (default=data/test.json)")
+parser.add_argument("-s", "--test_batch_size", type=int, help="specify the number of tasks scored per step")
+parser.add_argument("-w", "--test_window", type=int, help="stream the input data, reading this many questions at a time")
 args = parser.parse_args()
 
 dmn_type = args.dmn_type if args.dmn_type is not None else "plus"
@@ -27,9 +31,16 @@ if args.babi_task_id is not None:
 if args.input_data is not None:
     config.test_file = args.input_data
 
+if args.test_batch_size is not None:
+    config.test_batch_size = args.test_batch_size
+
+if args.test_window is not None:
+    config.test_window = args.test_window
+
 config.strong_supervision = False
 
 config.train_mode = False
+config.vocab_file = vocab_store.vocab_path('weights/task' + str(config.babi_id) + '.weights')
 
 print 'Testing DMN ' + dmn_type + ' on babi task', config.babi_id
 
@@ -49,14 +60,18 @@ saver = tf.train.Saver()
 with tf.Session() as session:
     session.run(init)
 
-    print '==> restoring weights'
-    saver.restore(session, 'weights/task' + str(model.config.babi_id) + '.weights')
+    slim_store.restore_weights(session, 'weights/task' + str(model.config.babi_id) + '.weights', saver)
 
     print '==> running DMN'
-    pred_list = model.run_test_epoch(session, model.test)
+    if config.test_window:
+        answers = model.predict_stream(session, model.test)
+    else:
+        answers = model.predict_answers(session, model.test)
     answer_file = open("answer.txt","w")
-    for pred in pred_list:
-        pred = np.reshape(pred, (-1,))
-        answer_file.write(str(np.argmax(pred)))
+    for answer in answers:
+        answer_file.write(str(answer))
         answer_file.write("\n")
 
+    if dmn_type == "plus" and model.fact_cache is not None:
+        print '==> fact cache: {hit_rate:.1%} hit rate, {bytes} bytes in {contexts} contexts'.format(**model.fact_cache.stats())
+
@@ -5,6 +5,9 @@ import time
 import argparse
 import os
 
+import vocab_store
+import slim_store
+
 parser = argparse.ArgumentParser()
 parser.add_argument("-b", "--babi_task_id", help="specify babi task 1-20 (default=1)")
 parser.add_argument("-r", "--restore", help="restore previously trained weights (default=false)")
@@ -12,6 +15,8 @@ parser.add_argument("-s", "--strong_supervision", help="use labelled supporting
 parser.add_argument("-t", "--dmn_type", help="specify type of dmn (default=original)")
 parser.add_argument("-l", "--l2_loss", type=float, default=0.001, help="specify l2 loss constant")
 parser.add_argument("-n", "--num_runs", type=int, help="specify the number of model runs")
+parser.add_argument("-p", "--prefetch_batches", type=int, help="prepare this many batches ahead in a background thread (default=0)")
+parser.add_argument("-w", "--tokenize_workers", type=int, help="tokenize the data in this many processes, 0 for one per core (default=1)")
 
 args = parser.parse_args()
 
@@ -35,6 +40,12 @@ config.l2 = args.l2_loss if args.l2_loss is not None else 0.001
 config.strong_supervision = args.strong_supervision if args.strong_supervision is not None else False
 num_runs = args.num_runs if args.num_runs is not None else 1
 
+if args.prefetch_batches is not None:
+    config.prefetch_batches = args.prefetch_batches
+
+if args.tokenize_workers is not None:
+    config.tokenize_workers = args.tokenize_workers
+
 print 'Training DMN ' + dmn_type + ' on babi task', config.babi_id
 
 best_overall_val_loss = float('inf')
@@ -96,6 +107,9 @@ for run in range(num_runs):
                     best_overall_val_loss = best_val_loss
                     best_val_accuracy = valid_accuracy
                     saver.save(session, 'weights/task' + str(model.config.babi_id) + '.weights')
+                    model.save_vocab(session, vocab_store.vocab_path('weights/task' + str(model.config.babi_id) + '.weights'))
+                    # the full checkpoint resumes training, the slim weights are what testing restores
+                    slim_store.save_slim('weights/task' + str(model.config.babi_id) + '.weights', config.slim_dtype)
 
             # anneal
             if train_loss>prev_epoch_loss*model.config.anneal_threshold:
@@ -6,3 +6,4 @@ mkdir data/glove
 mkdir data/glove/glove.6B
 mv glove.6B.100d.txt data/glove/glove.6B
 rm -f glove.6B*
+python glove_store.py -d 100
@@ -0,0 +1,63 @@
+import hashlib
+import threading
+import collections
+
+import numpy as np
+
+def context_key(words):
+    """Key of a context from its word ids, cut to its sentences and longest sentence"""
+    words = np.ascontiguousarray(words, dtype=np.int32)
+    return hashlib.sha1(words).hexdigest() + str(words.shape)
+
+class FactCache(object):
+    """LRU cache of the fact vectors of encoded contexts
+
+    Holds at most max_bytes of fact vectors, the least recently used contexts are evicted first.
+    The vectors are only valid for the weights they were computed with, clear the cache when they change."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # scoring can run from several server threads
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the fact vectors stored under key, or None"""
+        with self.lock:
+            facts = self.entries.pop(key, None)
+            if facts is None:
+                self.misses += 1
+                return None
+            # reinserted as the most recently used
+            self.entries[key] = facts
+            self.hits += 1
+            return facts
+
+    def put(self, key, facts):
+        if facts.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.nbytes
+            self.entries[key] = facts
+            self.bytes += facts.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Hit rate of the lookups so far and the memory held"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / float(lookups) if lookups else 0.,
+                    "contexts": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes}
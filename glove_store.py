@@ -0,0 +1,111 @@
+import os as os
+import argparse
+
+import numpy as np
+
+glove_dir = "./data/glove/glove.6B"
+
+def glove_path(dim, ext):
+    return os.path.join(glove_dir, "glove.6B." + str(dim) + "d" + ext)
+
+def convert_glove(dim):
+    """Converts the GloVe text file into a float32 matrix (.npy) and a word index (.vocab)"""
+    txt_file = glove_path(dim, ".txt")
+
+    print "==> converting %s" % txt_file
+    with open(txt_file) as f:
+        num_words = sum(1 for _ in f)
+
+    # write to temporary names first so an interrupted conversion is never picked up
+    tmp_npy = glove_path(dim, ".npy.tmp")
+    tmp_vocab = glove_path(dim, ".vocab.tmp")
+    vectors = np.lib.format.open_memmap(tmp_npy, mode='w+', dtype=np.float32, shape=(num_words, dim))
+    with open(txt_file) as f, open(tmp_vocab, 'w') as vocab_file:
+        for i, line in enumerate(f):
+            word, values = line.rstrip().split(' ', 1)
+            vectors[i] = np.array(values.split(), dtype=np.float32)
+            vocab_file.write(word + '\n')
+    vectors.flush()
+    del vectors
+
+    os.rename(tmp_npy, glove_path(dim, ".npy"))
+    os.rename(tmp_vocab, glove_path(dim, ".vocab"))
+    print "==> wrote %d x %d glove matrix" % (num_words, dim)
+
+class GloveStore(object):
+    """Dict-like word -> vector mapping backed by a memory-mapped GloVe matrix
+
+    Vectors are only paged in when looked up, and the pages are shared between
+    processes. Vectors stored for words missing from GloVe are kept in memory."""
+
+    def __init__(self, dim):
+        self.vectors = np.load(glove_path(dim, ".npy"), mmap_mode='r')
+        with open(glove_path(dim, ".vocab")) as f:
+            words = f.read().split('\n')[:-1]
+        self.index = dict((w, i) for i, w in enumerate(words))
+        self.missing = {}
+        assert self.vectors.shape == (len(self.index), dim)
+
+    def __contains__(self, word):
+        return word in self.index or word in self.missing
+
+    def __getitem__(self, word):
+        if word in self.missing:
+            return self.missing[word]
+        return self.vectors[self.index[word]]
+
+    def __setitem__(self, word, vector):
+        self.missing[word] = vector
+
+    def __len__(self):
+        return len(self.index) + len(self.missing)
+
+def load_glove(dim):
+    """Loads the binary GloVe store for dim, converting the text file on first use"""
+    if not os.path.exists(glove_path(dim, ".npy")):
+        convert_glove(dim)
+    return GloveStore(dim)
+
+def glove_files(dim):
+    """Files load_glove and load_glove_rows read the vectors of dim from"""
+    if os.path.exists(glove_path(dim, ".npy")):
+        return [glove_path(dim, ".npy"), glove_path(dim, ".vocab")]
+    return [glove_path(dim, ".txt")]
+
+def load_glove_rows(dim, vocab):
+    """Streams GloVe once and copies the vectors of the words in vocab into a preallocated matrix
+
+    Returns the (len(vocab), dim) float32 matrix indexed by vocab ids and a mask of the rows found.
+    Memory scales with len(vocab), the glove word index is never held in memory."""
+    embedding = np.zeros((len(vocab), dim), dtype=np.float32)
+    found = np.zeros(len(vocab), dtype=bool)
+
+    if os.path.exists(glove_path(dim, ".npy")):
+        rows = []
+        glove_rows = []
+        with open(glove_path(dim, ".vocab")) as f:
+            for j, line in enumerate(f):
+                i = vocab.get(line[:-1])
+                if i is not None:
+                    rows.append(i)
+                    glove_rows.append(j)
+        vectors = np.load(glove_path(dim, ".npy"), mmap_mode='r')
+        embedding[rows] = vectors[glove_rows]
+        found[rows] = True
+    else:
+        with open(glove_path(dim, ".txt")) as f:
+            for line in f:
+                i = vocab.get(line[:line.find(' ')])
+                if i is not None:
+                    embedding[i] = np.array(line.split()[1:], dtype=np.float32)
+                    found[i] = True
+
+    return embedding, found
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dims", type=int, nargs='+', default=[100], help="glove dimensions to convert (default=100)")
+    args = parser.parse_args()
+
+    for dim in args.dims:
+        convert_glove(dim)
@@ -0,0 +1,108 @@
+import time
+import threading
+import collections
+import Queue
+
+import numpy as np
+
+class _Request(object):
+
+    def __init__(self, items):
+        self.items = items
+        self.start = time.time()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+class MicroBatcher(object):
+    """Runs the items submitted by concurrent threads through predict in shared batches
+
+    A batch is run as soon as it holds max_batch_size items or its first request has waited
+    max_wait seconds. Requests are never split, one larger than max_batch_size runs alone.
+    predict takes a list of items and returns a list with one result per item."""
+
+    def __init__(self, predict, max_batch_size=16, max_wait=0.005, stats_size=10000):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.queue = Queue.Queue()
+        # request taken from the queue that did not fit in the previous batch
+        self.next_request = None
+
+        # latency of the last stats_size requests and size of the last stats_size batches
+        self.stats_lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=stats_size)
+        self.batch_sizes = collections.deque(maxlen=stats_size)
+
+        thread = threading.Thread(target=self.run_batches)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, items):
+        """Returns the results of items, blocking until the batch they joined has run"""
+        request = _Request(items)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def next_batch(self):
+        """Waits for a first request, then collects more until the batch is full or max_wait has passed"""
+        if self.next_request is not None:
+            batch, self.next_request = [self.next_request], None
+        else:
+            batch = [self.queue.get()]
+        size = len(batch[0].items)
+        deadline = batch[0].start + self.max_wait
+
+        while size < self.max_batch_size:
+            # requests already queued always join, new ones are only waited for until the deadline
+            timeout = deadline - time.time()
+            try:
+                request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if size + len(request.items) > self.max_batch_size:
+                self.next_request = request
+                break
+            batch.append(request)
+            size += len(request.items)
+        return batch
+
+    def run_batches(self):
+        while True:
+            batch = self.next_batch()
+            items = [item for request in batch for item in request.items]
+            try:
+                results = self.predict(items)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            else:
+                start = 0
+                for request in batch:
+                    request.results = results[start:start+len(request.items)]
+                    start += len(request.items)
+
+            end = time.time()
+            with self.stats_lock:
+                self.batch_sizes.append(len(items))
+                self.latencies.extend(end - request.start for request in batch)
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        """Latency percentiles (ms) of the recent requests and how full the recent batches were"""
+        with self.stats_lock:
+            latencies = 1000 * np.array(self.latencies)
+            batch_sizes = np.array(self.batch_sizes)
+        if len(batch_sizes) == 0:
+            return {"requests": 0, "batches": 0}
+
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        return {"requests": len(latencies), "batches": len(batch_sizes),
+                "latency_ms": {"p50": p50, "p90": p90, "p99": p99, "max": np.max(latencies)},
+                "mean_batch_size": np.mean(batch_sizes),
+                "batch_fill": np.mean(np.minimum(batch_sizes, self.max_batch_size)) / float(self.max_batch_size)}
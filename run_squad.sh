@@ -1,6 +1,12 @@
 input_file=$1
 output_file=$2
 
+# thin client for a running "python dmn_server.py -t squad", e.g. DMN_SERVER=http://localhost:8000
+if [ -n "$DMN_SERVER" ]; then
+    curl -sf --data-binary @$input_file $DMN_SERVER/answers > $output_file
+    exit $?
+fi
+
 if [ ! -d "weights" ]; then
     bash download_all.sh
 fi
@@ -0,0 +1,84 @@
+import os as os
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+import vocab_store
+
+# bump when the layout of the saved arrays changes
+SLIM_VERSION = 1
+
+def slim_path(weights_file):
+    """Slim weights saved next to a weights file, e.g. weights/SQUAD.weights -> weights/SQUAD.slim.npz"""
+    return os.path.splitext(weights_file)[0] + ".slim.npz"
+
+def is_slim_variable(name, embedding=False):
+    """Whether a checkpoint variable is needed for inference
+
+    The Adam slots and beta powers only resume training. The trained embedding
+    is already saved with the vocab, it is only kept when embedding is set."""
+    if name.endswith("Embedding"):
+        return embedding
+    return not ("Adam" in name or name.endswith("_power"))
+
+def save_slim(weights_file, dtype=np.float32):
+    """Writes the inference variables of a checkpoint to an npz file, stored as dtype
+
+    Checkpoints without a vocab file keep their embedding, the model then builds the vocab
+    from the training data and restores the trained embedding over it."""
+    embedding = not os.path.exists(vocab_store.vocab_path(weights_file))
+    if embedding:
+        print "==> no vocab saved with %s, keeping the embedding" % weights_file
+
+    reader = tf.train.NewCheckpointReader(weights_file)
+    arrays = dict((name, reader.get_tensor(name).astype(dtype)) for name in reader.get_variable_to_shape_map() if is_slim_variable(name, embedding))
+    np.savez(slim_path(weights_file), version=SLIM_VERSION, **arrays)
+    print "==> wrote %d %s variables to %s" % (len(arrays), np.dtype(dtype).name, slim_path(weights_file))
+
+def restore_slim(session, fname):
+    """Loads slim weights into the variables of the default graph with the same names
+
+    Unless the slim weights hold the embedding, the model must have been built with the saved vocab,
+    which initializes the embedding."""
+    saved = np.load(fname)
+    if int(saved["version"]) != SLIM_VERSION:
+        raise Exception("%s has slim version %d, expected %d" % (fname, saved["version"], SLIM_VERSION))
+
+    variables = dict((v.op.name, v) for v in tf.all_variables())
+    initializers = []
+    feed = {}
+    for name in saved.files:
+        if name == "version":
+            continue
+        v = variables[name]
+        # run the initializers with the saved values instead of adding assign ops
+        initializers.append(v.initializer)
+        feed[v.initial_value] = saved[name].astype(v.dtype.base_dtype.as_numpy_dtype)
+    session.run(initializers, feed_dict=feed)
+
+def restore_weights(session, weights_file, saver=None):
+    """Restores the slim weights of weights_file if they were saved, otherwise the full checkpoint"""
+    if os.path.exists(slim_path(weights_file)):
+        print '==> restoring slim weights'
+        restore_slim(session, slim_path(weights_file))
+    else:
+        print '==> restoring weights'
+        (saver or tf.train.Saver()).restore(session, weights_file)
+
+def checkpoint_files(weights_file):
+    """Files a checkpoint is written to"""
+    directory = os.path.dirname(weights_file) or "."
+    prefix = os.path.basename(weights_file) + "."
+    return [os.path.join(directory, f) for f in os.listdir(directory) if f.startswith(prefix)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--weights", nargs='+', default=["weights/SQUAD.weights", "weights/TOEFL.weights"], help="specify the checkpoints to slim (default=weights/SQUAD.weights weights/TOEFL.weights)")
+    parser.add_argument("--float16", action="store_true", help="store the weights as float16")
+    args = parser.parse_args()
+
+    for weights_file in args.weights:
+        save_slim(weights_file, np.float16 if args.float16 else np.float32)
+        full = sum(os.path.getsize(f) for f in checkpoint_files(weights_file))
+        print "==> %s: checkpoint %.1fMB, slim %.1fMB" % (weights_file, full / 1e6, os.path.getsize(slim_path(weights_file)) / 1e6)
@@ -1,68 +1,119 @@
 import sys
 import os as os
+import io
+import re
 import numpy as np
 import json
+import multiprocessing
+from itertools import chain, imap
+
+import glove_store
+import vocab_store
+import data_cache
 
 # can be sentence or word
 input_mask_mode = "sentence"
 
+# relevant labels of every task, the data files have no supporting facts
+supporting_facts = "0"
+
+train_file = "data/s_train.json"
+
+def iter_json_items(fname, chunk_size=1 << 20):
+    """Yields the objects of the top level JSON array in fname one by one, reading the file in chunks"""
+    decoder = json.JSONDecoder()
+    separators = re.compile(r'[\s,]*')
+    with io.open(fname, encoding='utf-8') as f:
+        buf = f.read(chunk_size).lstrip()
+        if not buf.startswith(u'['):
+            raise ValueError("%s does not hold a JSON array" % fname)
+        pos = 1
+        while True:
+            pos = separators.match(buf, pos).end()
+            if buf[pos:pos+1] == u']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # the next object is cut by the end of the buffer
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+
+def iter_windows(tasks, window):
+    """Groups consecutive tasks into lists holding the candidates of up to window questions"""
+    tasks_window = []
+    questions = 0
+    for task in tasks:
+        if not tasks_window or task["P"] != tasks_window[-1]["P"]:
+            if questions == window:
+                yield tasks_window
+                tasks_window = []
+                questions = 0
+            questions += 1
+        tasks_window.append(task)
+    if tasks_window:
+        yield tasks_window
+
 # adapted from https://github.com/YerevaNN/Dynamic-memory-networks-in-Theano/
 def init_babi(fname):
     
     print "==> Loading test from %s" % fname
-    tasks = []
-    task = None
+    #print pos_count
+    #exit(1)
+    return list(iter_babi(fname))
+
+def iter_babi(fname):
+    """Yields the tasks of fname while reading it"""
+    return iter_tasks(iter_json_items(fname))
+
+def iter_tasks(items):
+    """Yields the tasks of the question items of a data file, the candidates of a question are consecutive"""
     pos_count = 0
     neg_count = 0
-    with open(fname, 'r') as f:
-        data = json.load(f)
-        for line in data:
-            count = 0
-            for answer_list in line["answer_list"]:
-                task = {"C": "", "Q": "", "A": "", "S": ""}
-                task["C"] = line["context"].encode('utf-8')
-                task["Q"] = line["question"].encode('utf-8') + answer_list.encode('utf-8')
-                if "answer" in line:
-                    if not isinstance(line["answer"], list):
-                        line["answer"] = [line["answer"]]
-                    
-                    if count in line["answer"]:
-                        task["A"] = 1
-                    else :
-                        task["A"] = 0
-                else:
+    for p, line in enumerate(items):
+        count = 0
+        # all candidates of a question share one context string
+        context = line["context"].encode('utf-8')
+        for answer_list in line["answer_list"]:
+            task = {"C": "", "Q": "", "A": "", "S": "", "P": p}
+            task["C"] = context
+            task["Q"] = line["question"].encode('utf-8') + answer_list.encode('utf-8')
+            if "answer" in line:
+                if not isinstance(line["answer"], list):
+                    line["answer"] = [line["answer"]]
+                
+                if count in line["answer"]:
                     task["A"] = 1
+                else :
+                    task["A"] = 0
+            else:
+                task["A"] = 1
 
-                count += 1
-                task["S"] = "0"
-                if task["A"] == 1:
-                    tasks.append(task.copy())
-                    pos_count += 1
-                else: # task["A"] == 0
-                    if neg_count - pos_count < 10:
-                        tasks.append(task.copy())
-                        neg_count += 1
-
-    #print pos_count
-    #exit(1)
-    return tasks
+            count += 1
+            task["S"] = supporting_facts
+            if task["A"] == 1:
+                yield task.copy()
+                pos_count += 1
+            else: # task["A"] == 0
+                if neg_count - pos_count < 10:
+                    yield task.copy()
+                    neg_count += 1
 
 
 def get_babi_raw(test_file):
-    babi_train_raw = init_babi("data/s_train.json")
+    babi_train_raw = init_babi(train_file)
     babi_test_raw = init_babi(test_file)
     return babi_train_raw, babi_test_raw
 
             
 def load_glove(dim):
-    word2vec = {}
-    
     print "==> loading glove"
-    with open(("./data/glove/glove.6B/glove.6B." + str(dim) + "d.txt")) as f:
-        for line in f:    
-            l = line.split()
-            word2vec[l[0]] = map(float, l[1:])
-            
+    word2vec = glove_store.load_glove(dim)
     print "==> glove is loaded"
     
     return word2vec
@@ -76,8 +127,12 @@ def create_vector(word, word2vec, word_vector_size, silent=True):
         print "utils.py::create_vector => %s is missing" % word
     return vector
 
-def process_word(word, word2vec, vocab, ivocab, word_vector_size, to_return="word2vec", silent=True):
-    if not word in word2vec:
+def process_word(word, word2vec, vocab, ivocab, word_vector_size, to_return="word2vec", silent=True, grow_vocab=True):
+    if not grow_vocab and not word in vocab:
+        # unknown words share the <eos> padding token so the trained embedding keeps its shape
+        word = "<eos>"
+    # word2vec is None when vectors are only looked up once the vocab is complete
+    if word2vec is not None and not word in word2vec:
         create_vector(word, word2vec, word_vector_size, silent)
     if not word in vocab: 
         next_index = len(vocab)
@@ -91,52 +146,39 @@ def process_word(word, word2vec, vocab, ivocab, word_vector_size, to_return="wor
     elif to_return == "onehot":
         raise Exception("to_return = 'onehot' is not implemented yet")
 
-def process_input(data_raw, floatX, word2vec, vocab, ivocab, embed_size, split_sentences=False):
+def process_input(data_raw, floatX, word2vec, vocab, ivocab, embed_size, split_sentences=False, grow_vocab=True, num_workers=1):
+    # 0 workers uses every core
+    num_workers = num_workers or multiprocessing.cpu_count()
+    if num_workers > 1:
+        return process_input_parallel(data_raw, word2vec, vocab, ivocab, embed_size, split_sentences, grow_vocab, num_workers)
+
     questions = []
     inputs = []
     answers = []
     input_masks = []
     relevant_labels = []
+    # each context is processed once, tasks refer to it by its row in inputs
+    context_ids = []
+    context_rows = {}
     for x in data_raw:
-        if split_sentences:
-            #inp = x["C"].lower().split(' . ') 
-            inp = x["C"].lower().split('. ') 
-            inp = [w for w in inp if len(w) > 0]
-            inp = [i.split() for i in inp]
-        else:
-            inp = x["C"].lower().split(' ') 
-            inp = [w for w in inp if len(w) > 0]
-
-        q = x["Q"].lower().split(' ')
-        q = [w for w in q if len(w) > 0]
-
-        if split_sentences: 
-            inp_vector = [[process_word(word = w, 
-                                        word2vec = word2vec, 
-                                        vocab = vocab, 
-                                        ivocab = ivocab, 
-                                        word_vector_size = embed_size, 
-                                        to_return = "index") for w in s] for s in inp]
+        q = tokenize_question(x["Q"])
+
+        if x["P"] in context_rows:
+            context_ids.append(context_rows[x["P"]])
         else:
-            inp_vector = [process_word(word = w, 
-                                        word2vec = word2vec, 
-                                        vocab = vocab, 
-                                        ivocab = ivocab, 
-                                        word_vector_size = embed_size, 
-                                        to_return = "index") for w in inp]
-                                    
+            context_rows[x["P"]] = len(inputs)
+            context_ids.append(len(inputs))
+            process_context(x["C"], inputs, input_masks, floatX, word2vec, vocab, ivocab, embed_size, split_sentences, grow_vocab)
+
         q_vector = [process_word(word = w, 
                                     word2vec = word2vec, 
                                     vocab = vocab, 
                                     ivocab = ivocab, 
                                     word_vector_size = embed_size, 
-                                    to_return = "index") for w in q]
+                                    to_return = "index",
+                                    grow_vocab = grow_vocab) for w in q]
         
-        if split_sentences:
-            inputs.append(inp_vector)
-        else:
-            inputs.append(np.vstack(inp_vector).astype(floatX))
-        questions.append(np.vstack(q_vector).astype(floatX))
+        questions.append(np.array(q_vector, dtype=np.int32))
         #answers.append(process_word(word = x["A"], 
         #                                word2vec = word2vec, 
         #                                vocab = vocab, 
@@ -146,101 +188,306 @@ def process_input(data_raw, floatX, word2vec, vocab, ivocab, embed_size, split_s
         answers.append(x["A"])
         # NOTE: here we assume the answer is one word! 
 
-        if not split_sentences:
-            if input_mask_mode == 'word':
-                input_masks.append(np.array([index for index, w in enumerate(inp)], dtype=np.int32)) 
-            elif input_mask_mode == 'sentence': 
-                input_masks.append(np.array([index for index, w in enumerate(inp) if w == '.'], dtype=np.int32)) 
-            else:
-                raise Exception("invalid input_mask_mode")
-
         relevant_labels.append(x["S"])
    
-    return inputs, questions, answers, input_masks, relevant_labels 
+    return inputs, questions, answers, input_masks, relevant_labels, context_ids
+
+def tokenize_question(question):
+    q = question.lower().split(' ')
+    return [w for w in q if len(w) > 0]
+
+def tokenize_context(context, split_sentences=False):
+    if split_sentences:
+        #inp = context.lower().split(' . ') 
+        inp = context.lower().split('. ') 
+        inp = [w for w in inp if len(w) > 0]
+        inp = [i.split() for i in inp]
+    else:
+        inp = context.lower().split(' ') 
+        inp = [w for w in inp if len(w) > 0]
+    return inp
+
+def process_context(context, inputs, input_masks, floatX, word2vec, vocab, ivocab, embed_size, split_sentences=False, grow_vocab=True):
+    """Appends the word ids of a context to inputs (and its sentence mask to input_masks)"""
+    inp = tokenize_context(context, split_sentences)
+
+    if split_sentences: 
+        inp_vector = [[process_word(word = w, 
+                                    word2vec = word2vec, 
+                                    vocab = vocab, 
+                                    ivocab = ivocab, 
+                                    word_vector_size = embed_size, 
+                                    to_return = "index",
+                                    grow_vocab = grow_vocab) for w in s] for s in inp]
+    else:
+        inp_vector = [process_word(word = w, 
+                                    word2vec = word2vec, 
+                                    vocab = vocab, 
+                                    ivocab = ivocab, 
+                                    word_vector_size = embed_size, 
+                                    to_return = "index",
+                                    grow_vocab = grow_vocab) for w in inp]
+
+    add_context(inp, inp_vector, inputs, input_masks, split_sentences)
+
+def add_context(inp, inp_vector, inputs, input_masks, split_sentences=False):
+    if split_sentences:
+        inputs.append(inp_vector)
+    else:
+        inputs.append(np.array(inp_vector, dtype=np.int32))
+        input_masks.append(get_input_mask(inp))
+
+def get_input_mask(inp):
+    if input_mask_mode == 'word':
+        return np.array([index for index, w in enumerate(inp)], dtype=np.int32)
+    elif input_mask_mode == 'sentence': 
+        return np.array([index for index, w in enumerate(inp) if w == '.'], dtype=np.int32)
+    else:
+        raise Exception("invalid input_mask_mode")
+
+def tokenize_shard(args):
+    """Tokenizes a shard of (P, C, Q) tasks in a worker process
+
+    Words get shard-local ids in the order they first appear in, so the shard only sends back
+    its word list and flat id arrays: (P, ids, sentence lens or input mask) for each context
+    first seen in the shard, then the ids and lens of all questions."""
+    tasks, split_sentences = args
+    local_ids = {}
+    def to_ids(tokens):
+        return np.array([local_ids.setdefault(w, len(local_ids)) for w in tokens], dtype=np.int32)
+
+    contexts = []
+    seen = set()
+    questions = []
+    for p, c, q in tasks:
+        if p not in seen:
+            seen.add(p)
+            inp = tokenize_context(c, split_sentences)
+            if split_sentences:
+                contexts.append((p, to_ids(chain.from_iterable(inp)), np.array(map(len, inp), dtype=np.int32)))
+            else:
+                contexts.append((p, to_ids(inp), get_input_mask(inp)))
+        questions.append(to_ids(tokenize_question(q)))
+
+    words = sorted(local_ids, key=local_ids.get)
+    q_lens = np.array(map(len, questions), dtype=np.int32)
+    return words, contexts, np.concatenate(questions + [np.zeros(0, dtype=np.int32)]), q_lens
+
+def process_input_parallel(data_raw, word2vec, vocab, ivocab, embed_size, split_sentences=False, grow_vocab=True, num_workers=2):
+    """Same output as the serial process_input, with tokenization sharded across a process pool
+
+    Shards are contiguous, so adding their words in shard order grows the vocab (and draws the
+    random vectors of words missing from glove) exactly as the serial path does."""
+    shard_size = max((len(data_raw) + 4*num_workers - 1) / (4*num_workers), 1)
+    starts = range(0, len(data_raw), shard_size)
+    shards = [([(x["P"], x["C"], x["Q"]) for x in data_raw[start:start+shard_size]], split_sentences) for start in starts]
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        results = pool.map(tokenize_shard, shards)
+    finally:
+        pool.terminate()
+
+    questions = []
+    inputs = []
+    answers = []
+    input_masks = []
+    relevant_labels = []
+    context_ids = []
+    context_rows = {}
+    for start, (words, contexts, q_ids, q_lens) in zip(starts, results):
+        # global id of each shard-local id
+        remap = np.array([process_word(w, word2vec, vocab, ivocab, embed_size, to_return="index", grow_vocab=grow_vocab) for w in words], dtype=np.int32)
+        contexts = dict((p, (ids, extra)) for p, ids, extra in contexts)
+        shard_questions = np.split(remap[q_ids], np.cumsum(q_lens)[:-1])
+
+        for x, q in zip(data_raw[start:start+shard_size], shard_questions):
+            if x["P"] in context_rows:
+                context_ids.append(context_rows[x["P"]])
+            else:
+                context_rows[x["P"]] = len(inputs)
+                context_ids.append(len(inputs))
+                ids, extra = contexts[x["P"]]
+                if split_sentences:
+                    inputs.append([sen.tolist() for sen in np.split(remap[ids], np.cumsum(extra)[:-1])])
+                else:
+                    inputs.append(remap[ids])
+                    input_masks.append(extra)
+
+            questions.append(q)
+            answers.append(x["A"])
+            relevant_labels.append(x["S"])
+
+    return inputs, questions, answers, input_masks, relevant_labels, context_ids
 
 def get_lens(inputs, split_sentences=False):
-    lens = np.zeros((len(inputs)), dtype=int)
+    lens = np.zeros((len(inputs)), dtype=np.int32)
     for i, t in enumerate(inputs):
         lens[i] = t.shape[0]
     return lens
 
 def get_sentence_lens(inputs):
-    lens = np.zeros((len(inputs)), dtype=int)
-    sen_lens = []
-    max_sen_lens = []
-    for i, t in enumerate(inputs):
-        sentence_lens = np.zeros((len(t)), dtype=int)
-        for j, s in enumerate(t):
-            sentence_lens[j] = len(s)
-        lens[i] = len(t)
-        sen_lens.append(sentence_lens)
-        max_sen_lens.append(np.max(sentence_lens))
-    return lens, sen_lens, max(max_sen_lens)
-    
-
-def pad_inputs(inputs, lens, max_len, mode="", sen_lens=None, max_sen_len=None):
+    """Number of sentences of each context, lengths of all sentences one context after another and the longest one"""
+    lens = np.fromiter(imap(len, inputs), dtype=np.int32, count=len(inputs))
+    sen_lens = np.fromiter(imap(len, chain.from_iterable(inputs)), dtype=np.int32, count=np.sum(lens))
+    return lens, sen_lens, np.max(sen_lens)
+
+def scatter_sentences(padded, inputs, lens, sen_lens, chunk_size=1024):
+    """Writes the word ids of the ragged contexts straight into padded
+
+    Only the last padded.shape[1] sentences of a context and the first padded.shape[2]
+    words of a sentence are kept. Contexts are flattened chunk by chunk to bound the index arrays."""
+    max_len, max_sen_len = padded.shape[1:]
+    # first sentence of each context in sen_lens
+    sen_starts = np.concatenate([[0], np.cumsum(lens)])
+    for start in range(0, len(inputs), chunk_size):
+        end = min(start + chunk_size, len(inputs))
+        chunk_lens = lens[start:end]
+        chunk_sen_lens = sen_lens[sen_starts[start]:sen_starts[end]]
+        words = np.fromiter(chain.from_iterable(chain.from_iterable(inputs[start:end])), dtype=padded.dtype, count=np.sum(chunk_sen_lens))
+
+        # context and row of every sentence, sentences trimmed from the front get negative rows
+        sen_context = np.repeat(np.arange(start, end), chunk_lens)
+        first_kept = np.cumsum(chunk_lens) - np.minimum(chunk_lens, max_len)
+        sen_row = np.arange(len(chunk_sen_lens)) - np.repeat(first_kept, chunk_lens)
+
+        # sentence and position of every word
+        word_sen = np.repeat(np.arange(len(chunk_sen_lens)), chunk_sen_lens)
+        word_pos = np.arange(len(words)) - np.repeat(np.cumsum(chunk_sen_lens) - chunk_sen_lens, chunk_sen_lens)
+
+        keep = (sen_row[word_sen] >= 0) & (word_pos < max_sen_len)
+        word_sen = word_sen[keep]
+        padded[sen_context[word_sen], sen_row[word_sen], word_pos[keep]] = words[keep]
+
+
+def word_id_dtype(vocab_size):
+    """Smallest integer type holding every word id"""
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.int32
+
+def pad_inputs(inputs, lens, max_len, mode="", sen_lens=None, max_sen_len=None, dtype=np.int32):
     if mode == "mask":
-        padded = [np.pad(inp, (0, max_len - lens[i]), 'constant', constant_values=0) for i, inp in enumerate(inputs)]
-        return np.vstack(padded)
+        padded = np.zeros((len(inputs), max_len), dtype=dtype)
+        for i, inp in enumerate(inputs):
+            padded[i, :lens[i]] = inp
+        return padded
 
     elif mode == "split_sentences":
-        padded = np.zeros((len(inputs), max_len, max_sen_len))
-        for i, inp in enumerate(inputs):
-            padded_sentences = [np.pad(s, (0, max_sen_len - sen_lens[i][j]), 'constant', constant_values=0) for j, s in enumerate(inp)]
-            # trim array according to max allowed inputs
-            if len(padded_sentences) > max_len:
-                padded_sentences = padded_sentences[(len(padded_sentences)-max_len):]
-                lens[i] = max_len
-            padded_sentences = np.vstack(padded_sentences)
-            padded_sentences = np.pad(padded_sentences, ((0, max_len - lens[i]),(0,0)), 'constant', constant_values=0)
-            padded[i] = padded_sentences
+        padded = np.zeros((len(inputs), max_len, max_sen_len), dtype=dtype)
+        # sentences longer than max_sen_len (only possible with a saved vocab) are cut
+        scatter_sentences(padded, inputs, lens, sen_lens)
+        # trim array according to max allowed inputs
+        np.minimum(lens, max_len, out=lens)
         return padded
 
-    padded = [np.pad(np.squeeze(inp, axis=1), (0, max_len - lens[i]), 'constant', constant_values=0) for i, inp in enumerate(inputs)]
-    return np.vstack(padded)
+    padded = np.zeros((len(inputs), max_len), dtype=dtype)
+    for i, inp in enumerate(inputs):
+        padded[i, :lens[i]] = inp
+    return padded
 
 def create_embedding(word2vec, ivocab, embed_size):
-    embedding = np.zeros((len(ivocab), embed_size))
+    embedding = np.zeros((len(ivocab), embed_size), dtype=np.float32)
     for i in range(len(ivocab)):
         word = ivocab[i]
         embedding[i] = word2vec[word]
     return embedding
 
-def load_babi(config, split_sentences=False):
+def create_restricted_embedding(vocab, embed_size):
+    """Reads only the glove rows of words in vocab, missing words get the same random vectors as create_vector"""
+    embedding, found = glove_store.load_glove_rows(embed_size, vocab)
+    missing = np.logical_not(found)
+    embedding[missing] = np.random.uniform(0.0, 1.0, (np.sum(missing), embed_size))
+    print "==> %d / %d words found in glove" % (np.sum(found), len(vocab))
+    return embedding
+
+def load_test_babi(config, split_sentences=False):
+    """Processes only the test data, using the vocab and embedding saved with the weights"""
+    print "==> loading vocab from %s" % config.vocab_file
+    vocab, ivocab, word_embedding, max_sen_len = vocab_store.load_vocab(config.vocab_file)
+
+    babi_test_raw = init_babi(config.test_file)
+    print '==> get test inputs'
+    test_data = process_input(babi_test_raw, config.floatX, None, vocab, ivocab, config.embed_size, split_sentences, grow_vocab=False, num_workers=config.tokenize_workers)
+
+    return test_data, word_embedding, vocab, ivocab, max_sen_len
+
+def use_saved_vocab(config):
+    return not config.train_mode and config.vocab_file is not None and os.path.exists(config.vocab_file)
+
+def get_source_files(config):
+    """Files the output of process_babi depends on, including this module's code, and the GloVe files it reads
+
+    The GloVe files are returned apart, they are too large to hash on every startup."""
+    source_files = [os.path.splitext(os.path.abspath(__file__))[0] + ".py", config.test_file]
+    if use_saved_vocab(config):
+        return source_files + [config.vocab_file], []
+    source_files.append(train_file)
+    glove_files = glove_store.glove_files(config.embed_size) if config.word2vec_init else []
+    return source_files, glove_files
+
+def process_babi(config, split_sentences=False):
+    """Tokenizes and pads the train or test data, returns a dict of arrays and lengths"""
     vocab = {}
     ivocab = {}
 
-    babi_train_raw, babi_test_raw = get_babi_raw(config.test_file)
+    # sentence encoding length the model was trained with, if known
+    saved_max_sen_len = None
 
-    if config.word2vec_init:
-        assert config.embed_size == 100
-        word2vec = load_glove(config.embed_size)
-    else:
-        word2vec = {}
-
-    # set word at index zero to be end of sentence token so padding with zeros is consistent
-    process_word(word = "<eos>", 
-                word2vec = word2vec, 
-                vocab = vocab, 
-                ivocab = ivocab, 
-                word_vector_size = config.embed_size, 
-                to_return = "index")
-
-    print '==> get train inputs'
-    train_data = process_input(babi_train_raw, config.floatX, word2vec, vocab, ivocab, config.embed_size, split_sentences)
-    print '==> get test inputs'
-    test_data = process_input(babi_test_raw, config.floatX, word2vec, vocab, ivocab, config.embed_size, split_sentences)
+    if use_saved_vocab(config):
+        test_data, word_embedding, vocab, ivocab, saved_max_sen_len = load_test_babi(config, split_sentences)
 
-    if config.word2vec_init:
-        assert config.embed_size == 100
-        word_embedding = create_embedding(word2vec, ivocab, config.embed_size)
     else:
-        word_embedding = np.random.uniform(-config.embedding_init, config.embedding_init, (len(ivocab), config.embed_size))
+        babi_train_raw, babi_test_raw = get_babi_raw(config.test_file)
 
-    inputs, questions, answers, input_masks, rel_labels = train_data if config.train_mode else test_data
+        if config.word2vec_init and not config.word2vec_restrict:
+            word2vec = load_glove(config.embed_size)
+        else:
+            word2vec = None
+
+        # set word at index zero to be end of sentence token so padding with zeros is consistent
+        process_word(word = "<eos>", 
+                    word2vec = word2vec, 
+                    vocab = vocab, 
+                    ivocab = ivocab, 
+                    word_vector_size = config.embed_size, 
+                    to_return = "index")
+
+        print '==> get train inputs'
+        train_data = process_input(babi_train_raw, config.floatX, word2vec, vocab, ivocab, config.embed_size, split_sentences, num_workers=config.tokenize_workers)
+        print '==> get test inputs'
+        test_data = process_input(babi_test_raw, config.floatX, word2vec, vocab, ivocab, config.embed_size, split_sentences, num_workers=config.tokenize_workers)
+
+        if config.word2vec_init and config.word2vec_restrict:
+            word_embedding = create_restricted_embedding(vocab, config.embed_size)
+        elif config.word2vec_init:
+            word_embedding = create_embedding(word2vec, ivocab, config.embed_size)
+        else:
+            word_embedding = np.random.uniform(-config.embedding_init, config.embedding_init, (len(ivocab), config.embed_size))
+
+    data = pad_babi(train_data if config.train_mode else test_data, len(ivocab), config.max_allowed_inputs, split_sentences, saved_max_sen_len)
+    data["word_embedding"] = word_embedding
+    data["words"] = np.array([ivocab[i] for i in range(len(ivocab))])
+    return data
+
+def context_lens(inputs, chunk_size=1024):
+    """Longest sentence (up to its last non-padding word) and number of words of each padded context"""
+    sen_lens = np.zeros(len(inputs), dtype=np.int32)
+    num_words = np.zeros(len(inputs), dtype=np.int32)
+    for start in range(0, len(inputs), chunk_size):
+        words = inputs[start:start+chunk_size] != 0
+        num_words[start:start+chunk_size] = np.sum(np.sum(words, axis=2), axis=1)
+        positions = np.any(words, axis=1)
+        last = positions.shape[1] - np.argmax(positions[:, ::-1], axis=1)
+        sen_lens[start:start+chunk_size] = np.where(np.any(positions, axis=1), last, 0)
+    return sen_lens, num_words
+
+def pad_babi(data, vocab_size, max_allowed_inputs, split_sentences=False, saved_max_sen_len=None):
+    """Pads the output of process_input, returns a dict of arrays and lengths"""
+    inputs, questions, answers, input_masks, rel_labels, context_ids = data
 
     if split_sentences:
         input_lens, sen_lens, max_sen_len = get_sentence_lens(inputs)
+        if saved_max_sen_len is not None:
+            max_sen_len = saved_max_sen_len
         max_mask_len = max_sen_len
     else:
         input_lens = get_lens(inputs)
@@ -250,36 +497,91 @@ def load_babi(config, split_sentences=False):
     q_lens = get_lens(questions)
 
     max_q_len = np.max(q_lens)
-    max_input_len = min(np.max(input_lens), config.max_allowed_inputs)
+    max_input_len = min(np.max(input_lens), max_allowed_inputs)
 
-    #pad out arrays to max
+    #pad out arrays to max, word ids are stored in the smallest type that holds the vocab
+    dtype = word_id_dtype(vocab_size)
     if split_sentences:
-        inputs = pad_inputs(inputs, input_lens, max_input_len, "split_sentences", sen_lens, max_sen_len)
-        input_masks = np.zeros(len(inputs))
+        inputs = pad_inputs(inputs, input_lens, max_input_len, "split_sentences", sen_lens, max_sen_len, dtype)
+        input_masks = np.zeros(len(questions), dtype=np.int32)
+        # kept with the data so batching never has to scan the whole inputs array
+        context_sen_lens, context_num_words = context_lens(inputs)
     else:
-        inputs = pad_inputs(inputs, input_lens, max_input_len)
+        inputs = pad_inputs(inputs, input_lens, max_input_len, dtype=dtype)
         input_masks = pad_inputs(input_masks, mask_lens, max_mask_len, "mask")
+        context_sen_lens, context_num_words = np.zeros_like(input_lens), input_lens.copy()
 
-    questions = pad_inputs(questions, q_lens, max_q_len)
+    questions = pad_inputs(questions, q_lens, max_q_len, dtype=dtype)
 
     answers = np.stack(answers)
-    rel_labels = np.zeros((len(rel_labels), len(rel_labels[0])))
+    rel_labels = np.zeros((len(rel_labels), len(rel_labels[0])), dtype=np.int32)
 
     for i, tt in enumerate(rel_labels):
         rel_labels[i] = np.array(tt, dtype=int)
 
+    return {"questions": questions, "inputs": inputs, "q_lens": q_lens, "input_lens": input_lens,
+            "input_masks": input_masks, "answers": answers, "rel_labels": rel_labels,
+            "context_ids": np.array(context_ids, dtype=np.int32),
+            "sen_lens": context_sen_lens, "num_words": context_num_words,
+            "max_q_len": int(max_q_len), "max_input_len": int(max_input_len), "max_mask_len": int(max_mask_len)}
+
+def load_test_vocab(config):
+    """Vocab, embedding and sentence length saved with the weights, enough to process test data as it comes"""
+    if not use_saved_vocab(config):
+        raise Exception("processing test data on its own needs the vocab saved with the weights")
+    print "==> loading vocab from %s" % config.vocab_file
+    return vocab_store.load_vocab(config.vocab_file)
+
+def process_test_tasks(tasks, vocab, ivocab, max_sen_len, config, split_sentences=False):
+    """Tokenizes and pads tasks with a saved vocab, returns a test data tuple"""
+    data = process_input(tasks, config.floatX, None, vocab, ivocab, config.embed_size, split_sentences, grow_vocab=False)
+    data = pad_babi(data, len(ivocab), config.max_allowed_inputs, split_sentences, max_sen_len)
+    return (data["questions"], data["inputs"], data["q_lens"], data["input_lens"], data["input_masks"], data["answers"], data["rel_labels"], data["context_ids"],
+            data["sen_lens"], data["num_words"])
+
+def stream_test_babi(config, vocab, ivocab, max_sen_len, split_sentences=False):
+    """Reads, tokenizes and pads the test file config.test_window questions at a time
+
+    Memory is bounded by the window, not the file size."""
+    for tasks in iter_windows(iter_babi(config.test_file), config.test_window):
+        yield process_test_tasks(tasks, vocab, ivocab, max_sen_len, config, split_sentences)
+
+def load_babi(config, split_sentences=False):
+    # a cached test file would rarely be read again, and entries are never evicted
+    if config.cache_data and config.train_mode:
+        source_files, glove_files = get_source_files(config)
+        key = data_cache.cache_key(source_files,
+                [config.embed_size, config.max_allowed_inputs, config.train_mode, split_sentences,
+                 config.word2vec_init, config.word2vec_restrict, config.embedding_init], glove_files)
+        data = data_cache.load_arrays(key)
+        if data is None:
+            data_cache.save_arrays(key, process_babi(config, split_sentences))
+            # work on the memory-mapped copy even on the first run, the processed arrays are freed
+            data = data_cache.load_arrays(key)
+        else:
+            print "==> loaded cached data %s" % key
+    else:
+        data = process_babi(config, split_sentences)
+
+    questions, inputs, q_lens, input_lens = data["questions"], data["inputs"], data["q_lens"], data["input_lens"]
+    input_masks, answers, rel_labels, context_ids = data["input_masks"], data["answers"], data["rel_labels"], data["context_ids"]
+    sen_lens, num_words = data["sen_lens"], data["num_words"]
+    word_embedding, max_q_len, max_input_len, max_mask_len = data["word_embedding"], data["max_q_len"], data["max_input_len"], data["max_mask_len"]
+    ivocab = dict(enumerate(data["words"].tolist()))
+
     if config.train_mode:
-        train = questions[:config.num_train], inputs[:config.num_train], q_lens[:config.num_train], input_lens[:config.num_train], input_masks[:config.num_train], answers[:config.num_train], rel_labels[:config.num_train] 
+        # inputs and the context lens hold one row per context and are shared by both splits
+        train = questions[:config.num_train], inputs, q_lens[:config.num_train], input_lens, input_masks[:config.num_train], answers[:config.num_train], rel_labels[:config.num_train], context_ids[:config.num_train], sen_lens, num_words
 
-        valid = questions[config.num_train:], inputs[config.num_train:], q_lens[config.num_train:], input_lens[config.num_train:], input_masks[config.num_train:], answers[config.num_train:], rel_labels[config.num_train:]
+        valid = questions[config.num_train:], inputs, q_lens[config.num_train:], input_lens, input_masks[config.num_train:], answers[config.num_train:], rel_labels[config.num_train:], context_ids[config.num_train:], sen_lens, num_words
 
         print "len=",len(questions[:config.num_train]), len(questions[config.num_train:])
  
-        return train, valid, word_embedding, max_q_len, max_input_len, max_mask_len, rel_labels.shape[1], len(vocab)
+        return train, valid, word_embedding, max_q_len, max_input_len, max_mask_len, rel_labels.shape[1], len(ivocab), ivocab
 
     else:
-        test = questions, inputs, q_lens, input_lens, input_masks, answers, rel_labels
-        return test, word_embedding, max_q_len, max_input_len, max_mask_len, rel_labels.shape[1], len(vocab)
+        test = questions, inputs, q_lens, input_lens, input_masks, answers, rel_labels, context_ids, sen_lens, num_words
+        return test, word_embedding, max_q_len, max_input_len, max_mask_len, rel_labels.shape[1], len(ivocab), ivocab
 
 
     
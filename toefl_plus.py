@@ -1,5 +1,6 @@
 import sys
 import time
+import threading
 
 import numpy as np
 from copy import deepcopy
@@ -7,12 +8,16 @@ from copy import deepcopy
 import tensorflow as tf
 
 import toefl_input
+import vocab_store
+import fact_cache
+import dmn_common
 
 class Config(object):
     """Holds model hyperparams and data information."""
 
     batch_size = 4
-    test_batch_size = 4
+    # the graph takes any batch size, so inference can use large batches
+    test_batch_size = 64
     embed_size = 100
     hidden_size = 100
 
@@ -29,6 +34,8 @@ class Config(object):
 
     #word2vec_init = False
     word2vec_init = True
+    # only materialize the glove rows of words in the train/test vocab
+    word2vec_restrict = True
     embedding_init = 1.7320508 # root 3
 
     # set to zero with strong supervision to only train gates
@@ -44,6 +51,9 @@ class Config(object):
     num_attention_features = 4
 
     max_allowed_inputs = 100
+
+    # number of batches sorted by length together, 1 gives plain random batches
+    bucket_pool = 50
     num_train = 1500
 
     floatX = np.float32
@@ -53,6 +63,31 @@ class Config(object):
 
     test_file = "data/test.json"
 
+    # vocab saved with the weights, used instead of the training data in test mode
+    vocab_file = None
+
+    # questions read from the test file at a time, 0 loads the whole file before testing
+    test_window = 0
+
+    # cache the padded training data under a hash of the source files and config,
+    # test files change from run to run and are always processed again
+    cache_data = True
+
+    # processes tokenizing the raw data, 1 tokenizes in this process and 0 uses every core,
+    # the output is the same for any number. A pool only pays off for large training files on
+    # several cores, e.g. dmn_train.py -w 0
+    tokenize_workers = 1
+
+    # batches prepared ahead of the model by a background thread, 0 feeds each step directly,
+    # it only helps when a spare core prepares batches while the model runs, e.g. dmn_train.py -p 8
+    prefetch_batches = 0
+
+    # dtype of the inference-only weights saved next to each checkpoint, np.float16 halves them
+    slim_dtype = np.float32
+
+    # MB of context fact vectors kept between test batches so repeated passages are encoded once, 0 disables
+    fact_cache_mb = 64
+
     train_mode = True
 
 def _add_gradient_noise(t, stddev=1e-3, name=None):
@@ -87,17 +122,78 @@ def _xavier_weight_init():
         return out
     return _xavier_initializer
 
-# from https://danijar.com/variable-sequence-lengths-in-tensorflow/
-# used only for custom attention GRU as TF handles this with the sequence length param for normal RNNs
-def _last_relevant(output, length):
-    """Finds the output at the end of each input"""
-    batch_size = int(output.get_shape()[0])
-    max_length = int(output.get_shape()[1])
-    out_size = int(output.get_shape()[2])
-    index = tf.range(0, batch_size) * max_length + (length - 1)
-    flat = tf.reshape(output, [-1, out_size])
-    relevant = tf.gather(flat, index)
-    return relevant
+class _AttentionGRUCell(tf.nn.rnn_cell.RNNCell):
+    """Attention GRU as described by https://arxiv.org/abs/1603.01417
+
+    Inputs are the precomputed projections [rnn_input*Wr, rnn_input*W] of a fact followed by
+    its attention gate g, so only the recurrent matmuls run inside the loop."""
+
+    def __init__(self, num_units, Ur, br, U, bh):
+        self._num_units = num_units
+        self.Ur, self.br, self.U, self.bh = Ur, br, U, bh
+
+    @property
+    def state_size(self):
+        return self._num_units
+
+    @property
+    def output_size(self):
+        return self._num_units
+
+    def __call__(self, inputs, state, scope=None):
+        n = self._num_units
+        input_r, input_h, g = inputs[:, :n], inputs[:, n:2*n], inputs[:, 2*n:]
+
+        r = tf.sigmoid(input_r + tf.matmul(state, self.Ur) + self.br)
+        h_hat = tf.tanh(input_h + r*tf.matmul(state, self.U) + self.bh)
+        rnn_output = g*h_hat + (1-g)*state
+
+        return rnn_output, rnn_output
+
+def _bucket_batches(input_lens, sen_lens, batch_size, pool_size):
+    """Splits a random permutation into batches of examples with similar lengths
+
+    Each pool of pool_size batches is sorted by number of sentences and sentence length
+    before being cut into batches, then the batches of all pools are shuffled."""
+    p = np.random.permutation(len(input_lens))
+    batches = []
+    for start in range(0, len(p), batch_size*pool_size):
+        pool = p[start:start+batch_size*pool_size]
+        pool = pool[np.lexsort((sen_lens[pool], input_lens[pool]))]
+        batches += [pool[i:i+batch_size] for i in range(0, len(pool), batch_size)]
+    np.random.shuffle(batches)
+    return batches
+
+def _split_question_prefixes(questions, q_lens, first, context_index):
+    """Splits padded questions into the words shared by the questions of each context and the rest of each question
+
+    first holds a question of each context and context_index the context of each question. Returns the
+    prefixes and their lens, one per context, and the rest of each question shifted to the start of its row."""
+    # number of leading words each question has in common with the first question of its context
+    shared = np.minimum(np.sum(np.cumprod(questions == questions[first][context_index], axis=1), axis=1), q_lens)
+    prefix_lens = np.array(q_lens[first], dtype=np.int32)
+    np.minimum.at(prefix_lens, context_index, shared)
+    prefixes = questions[first, :max(np.max(prefix_lens), 1)]
+
+    starts = prefix_lens[context_index]
+    suffix_lens = (q_lens - starts).astype(np.int32)
+    cols = starts[:, None] + np.arange(max(np.max(suffix_lens), 1))
+    suffixes = questions[np.arange(len(questions))[:, None], np.minimum(cols, questions.shape[1] - 1)]
+    suffixes[cols >= q_lens[:, None]] = 0
+    return prefixes, prefix_lens, suffixes, suffix_lens
+
+def get_batch_arrays(data, index):
+    """Arrays of the tasks at index in batch_placeholders order, each distinct context is encoded once"""
+    qp, ip, ql, il, im, a, r, c, sl, nw = data
+    contexts, first, context_index = np.unique(c[index], return_index=True, return_inverse=True)
+    # cut questions, contexts and sentences to the longest ones in the batch,
+    # only those rows and columns are read when the data is memory-mapped
+    inputs = ip[contexts, :max(np.max(il[contexts]), 1), :max(np.max(sl[contexts]), 1)]
+    questions = qp[index, :max(np.max(ql[index]), 1)]
+    # the answer candidates of a question share its context
+    prefixes, prefix_lens, suffixes, suffix_lens = _split_question_prefixes(questions.astype(np.int32), ql[index], first, context_index)
+    return [prefixes, inputs.astype(np.int32), prefix_lens, il[contexts],
+            context_index, a[index], r[index], suffixes, suffix_lens]
     
 
 class DMN_PLUS(object):
@@ -105,24 +201,49 @@ class DMN_PLUS(object):
     def load_data(self, debug=False):
         """Loads train/valid/test data and sentence encoding"""
         if self.config.train_mode:
-            self.train, self.valid, self.word_embedding, self.max_q_len, self.max_input_len, self.max_sen_len, self.num_supporting_facts, self.vocab_size = toefl_input.load_babi(self.config, split_sentences=True)
+            self.train, self.valid, self.word_embedding, self.max_q_len, self.max_input_len, self.max_sen_len, self.num_supporting_facts, self.vocab_size, self.ivocab = toefl_input.load_babi(self.config, split_sentences=True)
+        elif self.config.test_window or self.config.test_file is None:
+            # test data is processed after the graph is built, window by window or request by request when serving
+            self.vocab, self.ivocab, self.word_embedding, self.max_sen_len = toefl_input.load_test_vocab(self.config)
+            self.vocab_size = len(self.ivocab)
+            self.num_supporting_facts = len(toefl_input.supporting_facts)
+            if self.config.test_file is not None:
+                # self.test is a generator of windows read from the test file while predicting
+                self.test = toefl_input.stream_test_babi(self.config, self.vocab, self.ivocab, self.max_sen_len, split_sentences=True)
         else:
-            self.test, self.word_embedding, self.max_q_len, self.max_input_len, self.max_sen_len, self.num_supporting_facts, self.vocab_size = toefl_input.load_babi(self.config, split_sentences=True)
+            self.test, self.word_embedding, self.max_q_len, self.max_input_len, self.max_sen_len, self.num_supporting_facts, self.vocab_size, self.ivocab = toefl_input.load_babi(self.config, split_sentences=True)
         self.encoding = _position_encoding(self.max_sen_len, self.config.embed_size)
 
     def add_placeholders(self):
         """add data placeholder to graph"""
-        self.question_placeholder = tf.placeholder(tf.int32, shape=(self.config.batch_size, self.max_q_len))
-        self.input_placeholder = tf.placeholder(tf.int32, shape=(self.config.batch_size, self.max_input_len, self.max_sen_len))
-
-        self.question_len_placeholder = tf.placeholder(tf.int32, shape=(self.config.batch_size,))
-        self.input_len_placeholder = tf.placeholder(tf.int32, shape=(self.config.batch_size,))
-
-        self.answer_placeholder = tf.placeholder(tf.float32, shape=(self.config.batch_size,))
-
-        self.rel_label_placeholder = tf.placeholder(tf.int32, shape=(self.config.batch_size, self.num_supporting_facts))
+        # question prefixes, inputs, question prefix lens, input lens, contexts, answers, rel labels,
+        # question suffixes, question suffix lens
+        # contexts are fed once per batch, however many tasks (answer candidates) ask about them,
+        # and the context of each task is its row in the inputs. The question words the candidates
+        # have in common are fed once per context too, each task only feeds the rest of its question
+        dtypes = [tf.int32, tf.int32, tf.int32, tf.int32, tf.int32, tf.float32, tf.int32, tf.int32, tf.int32]
+        shapes = [(None, None), (None, None, None), (None,), (None,), (None,), (None,), (None, self.num_supporting_facts),
+                  (None, None), (None,)]
+
+        # named so a frozen graph can be fed without the model object
+        names = ["questions", "inputs", "question_lens", "input_lens", "contexts", "answers", "rel_labels",
+                 "question_suffixes", "question_suffix_lens"]
+
+        if self.config.prefetch_batches:
+            # a background thread enqueues batches, feeding the placeholders directly bypasses the queue
+            self.batch_queue = tf.FIFOQueue(self.config.prefetch_batches, dtypes)
+            self.enqueue_placeholders = [tf.placeholder(dtype, shape=shape) for dtype, shape in zip(dtypes, shapes)]
+            self.enqueue_op = self.batch_queue.enqueue(self.enqueue_placeholders)
+            self.close_queue_op = self.batch_queue.close(cancel_pending_enqueues=True)
+            self.batch_placeholders = [tf.placeholder_with_default(t, shape, name=name) for t, shape, name in zip(self.batch_queue.dequeue(), shapes, names)]
+        else:
+            # without a queue a placeholder left unfed fails the step instead of waiting for a batch
+            self.batch_placeholders = [tf.placeholder(dtype, shape=shape, name=name) for dtype, shape, name in zip(dtypes, shapes, names)]
+        (self.question_placeholder, self.input_placeholder, self.question_len_placeholder, self.input_len_placeholder,
+            self.context_placeholder, self.answer_placeholder, self.rel_label_placeholder,
+            self.question_suffix_placeholder, self.question_suffix_len_placeholder) = self.batch_placeholders
 
-        self.dropout_placeholder = tf.placeholder(tf.float32)
+        self.dropout_placeholder = tf.placeholder(tf.float32, name="dropout")
 
     def add_reused_variables(self):
         """Adds trainable variables which are later reused""" 
@@ -135,18 +256,18 @@ class DMN_PLUS(object):
             self.gru_cell = gru_cell
 
         with tf.variable_scope("memory/attention", initializer=_xavier_weight_init()):
-            b_1 = tf.get_variable("bias_1", (self.config.embed_size,))
-            W_1 = tf.get_variable("W_1", (self.config.embed_size*self.config.num_attention_features, self.config.embed_size))
+            b_1 = tf.get_variable("bias_1", (self.config.hidden_size,))
+            W_1 = tf.get_variable("W_1", (self.config.hidden_size*self.config.num_attention_features, self.config.hidden_size))
 
-            W_2 = tf.get_variable("W_2", (self.config.embed_size, 1))
+            W_2 = tf.get_variable("W_2", (self.config.hidden_size, 1))
             b_2 = tf.get_variable("bias_2", 1)
 
         with tf.variable_scope("memory/attention_gru", initializer=_xavier_weight_init()):
-            Wr = tf.get_variable("Wr", (self.config.embed_size, self.config.hidden_size))
+            Wr = tf.get_variable("Wr", (self.config.hidden_size, self.config.hidden_size))
             Ur = tf.get_variable("Ur", (self.config.hidden_size, self.config.hidden_size))
             br = tf.get_variable("bias_r", (1, self.config.hidden_size))
 
-            W = tf.get_variable("W", (self.config.embed_size, self.config.hidden_size))
+            W = tf.get_variable("W", (self.config.hidden_size, self.config.hidden_size))
             U = tf.get_variable("U", (self.config.hidden_size, self.config.hidden_size))
             bh = tf.get_variable("bias_h", (1, self.config.hidden_size))
 
@@ -157,7 +278,7 @@ class DMN_PLUS(object):
         #pred = tf.argmax(preds, 1)
         # pred = tf.argmax(preds, 0)
         #pred = tf.greater(output, 0.5*tf.ones_like(output))
-        pred = output
+        pred = tf.identity(output, name="pred")
         return pred
       
     def add_loss_op(self, output):
@@ -174,7 +295,7 @@ class DMN_PLUS(object):
         loss = -self.config.beta*tf.reduce_sum(
             tf.mul(target, tf.log(output)) + tf.mul(1-target, tf.log(1-output))
         )
-        loss /= self.config.batch_size
+        loss /= tf.to_float(tf.shape(target)[0])
 
         # add l2 regularization for all variables except biases
         for v in tf.trainable_variables():
@@ -202,12 +323,14 @@ class DMN_PLUS(object):
 
     def get_question_representation(self, embeddings):
         """Get question vectors via embedding and GRU"""
-        questions = tf.nn.embedding_lookup(embeddings, self.question_placeholder)
-
-        questions = tf.split(1, self.max_q_len, questions)
-        questions = [tf.squeeze(q, squeeze_dims=[1]) for q in questions]
-
-        _, q_vec = tf.nn.rnn(self.gru_cell, questions, dtype=np.float32, sequence_length=self.question_len_placeholder)
+        # the shared prefix is run once per context, each candidate continues from its final state
+        prefixes = tf.nn.embedding_lookup(embeddings, self.question_placeholder)
+        _, prefix_state = tf.nn.dynamic_rnn(self.gru_cell, prefixes, dtype=np.float32, sequence_length=self.question_len_placeholder)
+
+        tf.get_variable_scope().reuse_variables()
+        suffixes = tf.nn.embedding_lookup(embeddings, self.question_suffix_placeholder)
+        _, q_vec = tf.nn.dynamic_rnn(self.gru_cell, suffixes, initial_state=tf.gather(prefix_state, self.context_placeholder),
+                sequence_length=self.question_suffix_len_placeholder)
         
         return q_vec
 
@@ -217,87 +340,103 @@ class DMN_PLUS(object):
         inputs = tf.nn.embedding_lookup(embeddings, self.input_placeholder)
 
         # use encoding to get sentence representation
-        inputs = tf.reduce_sum(inputs * self.encoding, 2)
-
-        inputs = tf.split(1, self.max_input_len, inputs)
-        inputs = [tf.squeeze(i, squeeze_dims=[1]) for i in inputs]
+        # batches are cut to their longest sentence, the encoded <eos> (id 0) padding past the cut
+        # is added back so the result is the same as for sentences padded to max_sen_len
+        sen_len = tf.shape(self.input_placeholder)[2]
+        encoding = tf.constant(self.encoding)
+        inputs = tf.reduce_sum(inputs * encoding[:sen_len], 2)
+        inputs += tf.gather(embeddings, 0) * tf.reduce_sum(encoding[sen_len:], 0)
 
-        outputs, _, _ = tf.nn.bidirectional_rnn(self.gru_cell, self.gru_cell, inputs, dtype=np.float32, sequence_length=self.input_len_placeholder)
+        outputs, _ = tf.nn.bidirectional_dynamic_rnn(self.gru_cell, self.gru_cell, inputs, dtype=np.float32, sequence_length=self.input_len_placeholder)
 
         # f<-> = f-> + f<-
-        fact_vecs = [tf.reduce_sum(tf.pack(tf.split(1, 2, out)), 0) for out in outputs]
-
-        # apply dropout
-        fact_vecs = [tf.nn.dropout(fv, self.dropout_placeholder) for fv in fact_vecs]
+        fact_vecs = outputs[0] + outputs[1]
 
         return fact_vecs
 
-    def get_attention(self, q_vec, prev_memory, fact_vec):
-        """Use question vector and previous memory to create scalar attention for current fact"""
+    def _split_attention_weights(self):
+        """Splits W_1 into the blocks applied to the question features and to the memory features"""
+        W_1 = tf.get_variable("W_1")
+        # rows of W_1 follow the features [f*q, f*m, |f-q|, |f-m|]
+        W_fq, W_fm, W_dq, W_dm = tf.split(0, self.config.num_attention_features, W_1)
+        return tf.concat(0, [W_fq, W_dq]), tf.concat(0, [W_fm, W_dm])
+
+    def get_question_attention(self, q_vec, fact_vecs, W_q):
+        """Part of the attention hidden layer that depends only on the question, shared by all hops"""
         with tf.variable_scope("attention", reuse=True, initializer=_xavier_weight_init()):
 
-            W_1 = tf.get_variable("W_1")
             b_1 = tf.get_variable("bias_1")
 
+            # broadcast question over the facts axis
+            q_vec = tf.expand_dims(q_vec, 1)
+            features = tf.concat(2, [fact_vecs*q_vec, tf.abs(fact_vecs - q_vec)])
+            features = tf.reshape(features, (-1, 2*self.config.hidden_size))
+
+            return tf.reshape(tf.matmul(features, W_q), tf.shape(fact_vecs)) + b_1
+
+    def get_attention(self, question_attention, W_m, prev_memory, fact_vecs):
+        """Use question attention and previous memory to create scalar attention for all facts at once"""
+        with tf.variable_scope("attention", reuse=True, initializer=_xavier_weight_init()):
+
             W_2 = tf.get_variable("W_2")
             b_2 = tf.get_variable("bias_2")
 
-            #print fact_vec.get_shape()
-            #print q_vec.get_shape()
-            features = [fact_vec*q_vec, fact_vec*prev_memory, tf.abs(fact_vec - q_vec), tf.abs(fact_vec - prev_memory)]
+            # broadcast memory over the facts axis
+            prev_memory = tf.expand_dims(prev_memory, 1)
+            features = tf.concat(2, [fact_vecs*prev_memory, tf.abs(fact_vecs - prev_memory)])
+            features = tf.reshape(features, (-1, 2*self.config.hidden_size))
+
+            # score the facts of all examples with one matmul
+            hidden = tf.tanh(question_attention + tf.reshape(tf.matmul(features, W_m), tf.shape(fact_vecs)))
+            attention = tf.matmul(tf.reshape(hidden, (-1, self.config.hidden_size)), W_2) + b_2
 
-            feature_vec = tf.concat(1, features)
-            #print feature_vec.get_shape()
-            #print W_2.get_shape()
-            #print b_2.get_shape()
-            attention = tf.matmul(tf.tanh(tf.matmul(feature_vec, W_1) + b_1), W_2) + b_2
-            
-        return attention
+        return tf.reshape(attention, tf.shape(fact_vecs)[:2])
 
-    def _attention_GRU_step(self, rnn_input, h, g):
-        """Implement attention GRU as described by https://arxiv.org/abs/1603.01417"""
+    def get_fact_inputs(self, fact_vecs):
+        """Input projections of the attention GRU for all facts at once, shared by all hops"""
         with tf.variable_scope("attention_gru", reuse=True, initializer=_xavier_weight_init()):
 
             Wr = tf.get_variable("Wr")
+            W = tf.get_variable("W")
+
+            facts = tf.reshape(fact_vecs, (-1, self.config.hidden_size))
+            input_r = tf.reshape(tf.matmul(facts, Wr), tf.shape(fact_vecs))
+            input_h = tf.reshape(tf.matmul(facts, W), tf.shape(fact_vecs))
+            return tf.concat(2, [input_r, input_h])
+
+    def _attention_GRU(self, fact_inputs, g):
+        """Run the attention GRU over the facts up to each example's last fact and return its final state"""
+        with tf.variable_scope("attention_gru", reuse=True, initializer=_xavier_weight_init()):
+
             Ur = tf.get_variable("Ur")
             br = tf.get_variable("bias_r")
 
-            W = tf.get_variable("W")
             U = tf.get_variable("U")
             bh = tf.get_variable("bias_h")
 
-            r = tf.sigmoid(tf.matmul(rnn_input, Wr) + tf.matmul(h, Ur) + br)
-            h_hat = tf.tanh(tf.matmul(rnn_input, W) + r*tf.matmul(h, U) + bh)
-            rnn_output = g*h_hat + (1-g)*h
+            inputs = tf.concat(2, [fact_inputs, tf.expand_dims(g, 2)])
+
+            # the state is carried through unchanged after an example's last fact
+            cell = _AttentionGRUCell(self.config.hidden_size, Ur, br, U, bh)
+            _, episode = tf.nn.dynamic_rnn(cell, inputs, dtype=np.float32, sequence_length=self.fact_len)
 
-            return rnn_output
+            return episode
 
-    def generate_episode(self, memory, q_vec, fact_vecs):
+    def generate_episode(self, memory, question_attention, W_m, fact_vecs, fact_inputs):
         """Generate episode by applying attention to current fact vectors through a modified GRU"""
 
-        attentions = [tf.squeeze(self.get_attention(q_vec, memory, fv), squeeze_dims=[1]) for fv in fact_vecs]
+        attentions = self.get_attention(question_attention, W_m, memory, fact_vecs)
 
-        attentions = tf.transpose(tf.pack(attentions))
+        # padded facts get no attention
+        mask = tf.sequence_mask(self.fact_len, tf.shape(attentions)[1])
+        attentions = tf.select(mask, attentions, tf.fill(tf.shape(attentions), -1e30))
 
         self.attentions.append(attentions)
 
         softs = tf.nn.softmax(attentions)
-        softs = tf.split(1, self.max_input_len, softs)
-        
-        gru_outputs = []
-
-        # set initial state to zero
-        h = tf.zeros((self.config.batch_size, self.config.hidden_size))
 
         # use attention gru
-        for i, fv in enumerate(fact_vecs):
-            h = self._attention_GRU_step(fv, h, softs[i])
-            gru_outputs.append(h)
-
-        # extract gru outputs at proper index according to input_lens
-        gru_outputs = tf.pack(gru_outputs)
-        gru_outputs = tf.transpose(gru_outputs, perm=[1,0,2])
-        episode = _last_relevant(gru_outputs, self.input_len_placeholder)
+        episode = self._attention_GRU(fact_inputs, softs)
 
         return episode
 
@@ -307,7 +446,7 @@ class DMN_PLUS(object):
 
             rnn_output = tf.nn.dropout(rnn_output, self.dropout_placeholder)
 
-            U = tf.get_variable("U", (2*self.config.embed_size, 1))
+            U = tf.get_variable("U", (2*self.config.hidden_size, 1))
             b_p = tf.get_variable("bias_p", (1,))
 
             output = tf.sigmoid(tf.matmul(tf.concat(1, [rnn_output, q_vec]), U) + b_p)
@@ -317,17 +456,27 @@ class DMN_PLUS(object):
         """Performs inference on the DMN model"""
 
         # set up embedding
-        embeddings = tf.Variable(self.word_embedding.astype(np.float32), name="Embedding")
+        self.embeddings = tf.Variable(self.word_embedding.astype(np.float32), name="Embedding")
          
         # input fusion module
         with tf.variable_scope("question", initializer=_xavier_weight_init()):
             print '==> get question representation'
-            q_vec = self.get_question_representation(embeddings)
+            q_vec = self.get_question_representation(self.embeddings)
          
 
         with tf.variable_scope("input", initializer=_xavier_weight_init()):
             print '==> get input representation'
-            fact_vecs = self.get_input_representation(embeddings)
+            fact_vecs = self.get_input_representation(self.embeddings)
+
+        # fed with cached facts when testing, which skips the input module
+        self.context_fact_vecs = fact_vecs
+
+        # share each context's facts between the tasks asking about it
+        fact_vecs = tf.gather(fact_vecs, self.context_placeholder)
+        self.fact_len = tf.gather(self.input_len_placeholder, self.context_placeholder)
+
+        # apply dropout
+        fact_vecs = tf.nn.dropout(fact_vecs, self.dropout_placeholder)
 
         # keep track of attentions for possible strong supervision
         self.attentions = []
@@ -336,16 +485,23 @@ class DMN_PLUS(object):
         with tf.variable_scope("memory", initializer=_xavier_weight_init()):
             print '==> build episodic memory'
 
+            # the split of W_1, the question's share of the attention and the attention GRU
+            # input projections are the same for every hop
+            with tf.variable_scope("attention", reuse=True):
+                W_q, W_m = self._split_attention_weights()
+            question_attention = self.get_question_attention(q_vec, fact_vecs, W_q)
+            fact_inputs = self.get_fact_inputs(fact_vecs)
+
             # generate n_hops episodes
             prev_memory = q_vec
 
             for i in range(self.config.num_hops):
                 # get a new episode
                 print '==> generating episode', i
-                episode = self.generate_episode(prev_memory, q_vec, fact_vecs)
+                episode = self.generate_episode(prev_memory, question_attention, W_m, fact_vecs, fact_inputs)
 
                 # untied weights for memory update
-                Wt = tf.get_variable("W_t"+ str(i), (2*self.config.hidden_size+self.config.embed_size, self.config.hidden_size))
+                Wt = tf.get_variable("W_t"+ str(i), (3*self.config.hidden_size, self.config.hidden_size))
                 bt = tf.get_variable("bias_t"+ str(i), (self.config.hidden_size,))
 
                 # update memory with Relu
@@ -359,13 +515,110 @@ class DMN_PLUS(object):
         return output
 
 
+    def save_vocab(self, session, fname):
+        """Saves the vocab and trained embedding so test mode never needs the training data"""
+        vocab_store.save_vocab(fname, self.ivocab, session.run(self.embeddings), self.max_sen_len)
+
+    def get_batch_feed(self, data, index, dp):
+        """Feed dict for the tasks at index"""
+        feed = dict(zip(self.batch_placeholders, get_batch_arrays(data, index)))
+        feed[self.dropout_placeholder] = dp
+        return feed
+
+    def start_prefetch(self, session, data, batches):
+        """Starts a thread enqueueing the batches in order while the model runs on earlier ones"""
+        def enqueue_batches():
+            try:
+                for index in batches:
+                    arrays = get_batch_arrays(data, index)
+                    session.run(self.enqueue_op, feed_dict=dict(zip(self.enqueue_placeholders, arrays)))
+            except Exception:
+                # unblock the training loop instead of leaving it waiting on the queue
+                session.run(self.close_queue_op)
+                raise
+
+        thread = threading.Thread(target=enqueue_batches)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run_cached_step(self, session, data, index):
+        """Predictions for the tasks at index, with the fact vectors of their contexts taken from the fact cache
+
+        A batch with nothing cached runs the whole model and caches its facts, otherwise only the missing
+        contexts are run through the input module and every fact vector is fed to the memory module"""
+        qp, ip, ql, il, im, a, r, c, sl, nw = data
+        arrays = get_batch_arrays(data, index)
+        inputs, input_lens = arrays[1], arrays[3]
+        contexts = np.unique(c[index])
+
+        keys = [fact_cache.context_key(ip[i, :il[i], :sl[i]]) for i in contexts]
+        # a passage asked about by several questions of the batch is looked up and encoded once
+        facts = dict((key, self.fact_cache.get(key)) for key in set(keys))
+        missing = [key for key in facts if facts[key] is None]
+        rows = [keys.index(key) for key in missing]
+
+        feed = dict(zip(self.batch_placeholders, arrays))
+        feed[self.dropout_placeholder] = 1
+        if len(missing) == len(facts):
+            # nothing cached, the input module runs with the rest of the model
+            pred, encoded = session.run([self.pred, self.context_fact_vecs], feed_dict=feed)
+            encoded = encoded[rows]
+        else:
+            encoded = []
+            if missing:
+                # dropout is fed for models built with drop_grus
+                encoded = session.run(self.context_fact_vecs, feed_dict={
+                    self.input_placeholder: inputs[rows], self.input_len_placeholder: input_lens[rows],
+                    self.dropout_placeholder: 1})
+                for key, j, e in zip(missing, rows, encoded):
+                    facts[key] = e[:input_lens[j]]
+
+            # the input module leaves zeros past the end of each context
+            fact_vecs = np.zeros((len(contexts), inputs.shape[1], self.config.hidden_size), dtype=np.float32)
+            for j, key in enumerate(keys):
+                fact_vecs[j, :len(facts[key])] = facts[key]
+            feed[self.context_fact_vecs] = fact_vecs
+            pred = session.run(self.pred, feed_dict=feed)
+
+        # copied so the cache holds no references to the batch arrays
+        for key, j, e in zip(missing, rows, encoded):
+            self.fact_cache.put(key, e[:input_lens[j]].copy())
+        return pred
+
+    def get_step_feeds(self, session, data, batches, dp):
+        """Yields the feed dict of each batch, only the dropout is fed when the batches are prefetched"""
+        if not self.config.prefetch_batches:
+            for index in batches:
+                yield self.get_batch_feed(data, index, dp)
+            return
+
+        thread = self.start_prefetch(session, data, batches)
+        for index in batches:
+            yield {self.dropout_placeholder: dp}
+        thread.join()
+
+    def get_padding_ratios(self, data, batches):
+        """Fraction of padding fed to the input module with full padding and with batches cut to their lengths"""
+        qp, ip, ql, il, im, a, r, c, sl, nw = data
+        words = full_slots = cut_slots = 0
+        for index in batches:
+            contexts = np.unique(c[index])
+            words += np.sum(nw[contexts])
+            full_slots += len(contexts) * self.max_input_len * self.max_sen_len
+            # the input GRU stops at the longest context of the batch
+            cut_slots += len(contexts) * np.max(il[contexts]) * max(np.max(sl[contexts]), 1)
+        if full_slots == 0:
+            # empty split, e.g. no validation examples left after num_train
+            return 0., 0.
+        return 1 - words / float(full_slots), 1 - words / float(cut_slots)
+
     def run_epoch(self, session, data, num_epoch=0, train_writer=None, train_op=None, verbose=2, train=False):
         config = self.config
         dp = config.dropout
         if train_op is None:
-            train_op = tf.no_op()
+            train_op = self.no_op
             dp = 1
-        total_steps = len(data[0]) / config.batch_size
         total_loss = []
         accuracy = 0
 
@@ -373,20 +626,17 @@ class DMN_PLUS(object):
         #print "*len(data[0])=",len(data[0])
         #print "****total_steps=",total_steps
  
-        # shuffle data
-        p = np.random.permutation(len(data[0]))
-        qp, ip, ql, il, im, a, r = data
-        qp, ip, ql, il, im, a, r = qp[p], ip[p], ql[p], il[p], im[p], a[p], r[p]
-
-        for step in range(total_steps):
-            index = range(step*config.batch_size,(step+1)*config.batch_size)
-            feed = {self.question_placeholder: qp[index],
-                  self.input_placeholder: ip[index],
-                  self.question_len_placeholder: ql[index],
-                  self.input_len_placeholder: il[index],
-                  self.answer_placeholder: a[index],
-                  self.rel_label_placeholder: r[index],
-                  self.dropout_placeholder: dp}
+        # shuffle data into batches of similar lengths, the last batch may be smaller than batch_size
+        qp, ip, ql, il, im, a, r, c, sl, nw = data
+        batches = _bucket_batches(il[c], sl[c], config.batch_size, config.bucket_pool)
+        total_steps = len(batches)
+
+        if verbose:
+            print 'Padding: {:.1%} -> {:.1%}'.format(*self.get_padding_ratios(data, batches))
+        start = time.time()
+
+        for step, feed in enumerate(self.get_step_feeds(session, data, batches, dp)):
+            index = batches[step]
             loss, pred, summary, _ = session.run(
               [self.calculate_loss, self.pred, self.merged, train_op], feed_dict=feed)
 
@@ -397,8 +647,8 @@ class DMN_PLUS(object):
             pred[pred < 0.5] = 0
             pred[pred >= 0.5] = 1
             pred = pred.astype(np.int64)
-            answers = a[step*config.batch_size:(step+1)*config.batch_size]
-            accuracy += np.sum(pred == answers)/float(len(answers))
+            answers = a[index]
+            accuracy += np.sum(pred == answers)
 
             total_loss.append(loss)
             if verbose and step % verbose == 0:
@@ -409,35 +659,33 @@ class DMN_PLUS(object):
 
         if verbose:
             sys.stdout.write('\r')
+            print 'Examples per second: {:.1f}'.format(len(data[0]) / (time.time() - start))
 
-        return np.mean(total_loss), accuracy/float(total_steps)
+        return np.mean(total_loss) if total_loss else 0., accuracy/float(max(len(data[0]), 1))
 
     def run_test_epoch(self, session, data, num_epoch=0, train_writer=None, train_op=None, verbose=2, train=False):
         config = self.config
         dp = config.dropout
         if train_op is None:
-            train_op = tf.no_op()
+            train_op = self.no_op
             dp = 1
-        total_steps = len(data[0]) / config.test_batch_size
+        total_steps = (len(data[0]) + config.test_batch_size - 1) / config.test_batch_size
         #total_loss = []
         #accuracy = 0
 
  
         # shuffle data
         #p = np.random.permutation(len(data[0]))
-        qp, ip, ql, il, im, a, r = data   # WE need a new data parser when testing , because there will be no a !
         #qp, ip, ql, il, im, a, r = qp[p], ip[p], ql[p], il[p], im[p], a[p], r[p] 
 
+        batches = [range(step*config.test_batch_size, min((step+1)*config.test_batch_size, len(data[0]))) for step in range(total_steps)]
+
+        # cached facts are only valid without dropout
+        if self.fact_cache is not None and dp == 1:
+            return [self.run_cached_step(session, data, index) for index in batches]
+
         pred_list = []
-        for step in range(total_steps):
-            index = range(step*config.test_batch_size,(step+1)*config.test_batch_size)
-            feed = {self.question_placeholder: qp[index],
-                  self.input_placeholder: ip[index],
-                  self.question_len_placeholder: ql[index],
-                  self.input_len_placeholder: il[index],
-                  #self.answer_placeholder: a[index],
-                  self.rel_label_placeholder: r[index],
-                  self.dropout_placeholder: dp}
+        for step, feed in enumerate(self.get_step_feeds(session, data, batches, dp)):
             #loss, pred, summary, _ = session.run(
             #  [self.calculate_loss, self.pred, self.merged, train_op], feed_dict=feed)
             pred  ,_ = session.run(
@@ -467,6 +715,23 @@ class DMN_PLUS(object):
         #return np.mean(total_loss), accuracy/float(total_steps)
         return pred_list
 
+    def get_test_data(self, items):
+        return dmn_common.get_test_data(toefl_input, items, self.vocab, self.ivocab, self.max_sen_len, self.config)
+
+    def predict_scores(self, session, data):
+        """Returns the scores of the answer candidates of each question"""
+        preds = np.concatenate([np.reshape(pred, (-1,)) for pred in self.run_test_epoch(session, data)])
+        return dmn_common.split_questions(preds, data[7])
+
+    def predict_answers(self, session, data):
+        return dmn_common.best_answers(self.predict_scores(session, data))
+
+    def predict_stream(self, session, windows):
+        """Yields the answers of test data windows as they are scored"""
+        for data in windows:
+            for answer in self.predict_answers(session, data):
+                yield answer
+
     def __init__(self, config):
 
         self.config = config
@@ -479,4 +744,10 @@ class DMN_PLUS(object):
         self.calculate_loss = self.add_loss_op(self.output)
         self.train_step = self.add_training_op(self.calculate_loss)
         self.merged = tf.merge_all_summaries()
+        # fetched instead of the train op when evaluating, made once so scoring from other threads adds no ops
+        self.no_op = tf.no_op()
+        # the weights only stay fixed in test mode
+        self.fact_cache = None
+        if not config.train_mode and config.fact_cache_mb:
+            self.fact_cache = fact_cache.FactCache(config.fact_cache_mb << 20)
 
@@ -0,0 +1,68 @@
+import os as os
+import copy
+import argparse
+
+import numpy as np
+
+# bump when the layout of the saved arrays changes
+VOCAB_VERSION = 1
+
+def vocab_path(weights_file):
+    """Vocab file saved next to a weights file, e.g. weights/SQUAD.weights -> weights/SQUAD.vocab.npz"""
+    return os.path.splitext(weights_file)[0] + ".vocab.npz"
+
+def save_vocab(fname, ivocab, word_embedding, max_sen_len):
+    """Saves the word ids, embedding and sentence encoding length a model was trained with"""
+    words = np.array([ivocab[i] for i in range(len(ivocab))])
+    np.savez(fname, version=VOCAB_VERSION, words=words, embedding=word_embedding, max_sen_len=max_sen_len)
+
+def load_vocab(fname):
+    """Returns vocab, ivocab, word_embedding and max_sen_len saved by save_vocab"""
+    saved = np.load(fname)
+    if int(saved["version"]) != VOCAB_VERSION:
+        raise Exception("%s has vocab version %d, expected %d" % (fname, saved["version"], VOCAB_VERSION))
+
+    ivocab = dict(enumerate(saved["words"].tolist()))
+    vocab = dict((w, i) for i, w in ivocab.iteritems())
+    return vocab, ivocab, saved["embedding"], int(saved["max_sen_len"])
+
+def migrate_vocab(weights_file, input_module, config, scope="DMN"):
+    """Saves the vocab of a checkpoint trained before vocab files were saved
+
+    The word ids are rebuilt from the training data and config.test_file the way load_babi built them,
+    so config.test_file must be the test file the checkpoint was trained with. The embedding is the
+    checkpoint's and the sentence encoding length the one of the training data."""
+    # only migrating needs tensorflow
+    import tensorflow as tf
+
+    config = copy.copy(config)
+    config.train_mode = True
+    config.vocab_file = None
+    # the embedding is taken from the checkpoint, glove is never read
+    config.word2vec_init = False
+    print "==> rebuilding the vocab of %s" % weights_file
+    data = input_module.process_babi(config, split_sentences=True)
+
+    word_embedding = tf.train.NewCheckpointReader(weights_file).get_tensor(scope + "/Embedding")
+    if len(data["words"]) != len(word_embedding):
+        raise ValueError("%s and %s give %d words but %s has %d, pass the test file it was trained with"
+                         % (input_module.train_file, config.test_file, len(data["words"]), weights_file, len(word_embedding)))
+
+    save_vocab(vocab_path(weights_file), dict(enumerate(data["words"].tolist())), word_embedding, data["max_mask_len"])
+    print "==> wrote %d words to %s" % (len(word_embedding), vocab_path(weights_file))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--tasks", nargs='+', default=["squad", "toefl"], help="specify the models to save the vocab of, squad or toefl (default=squad toefl)")
+    parser.add_argument("-w", "--weights", help="specify the weights file of a single task (default=weights/SQUAD.weights or weights/TOEFL.weights)")
+    parser.add_argument("-i", "--test_file", help="specify the test file the weights were trained with (default=data/test.json)")
+    args = parser.parse_args()
+
+    for task in args.tasks:
+        if task not in ("squad", "toefl"):
+            raise NotImplementedError(task + ' is not a supported task')
+        weights = args.weights if args.weights is not None else "weights/%s.weights" % task.upper()
+        config = __import__(task + "_plus").Config()
+        if args.test_file is not None:
+            config.test_file = args.test_file
+        migrate_vocab(weights, __import__(task + "_input"), config)